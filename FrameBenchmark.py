@@ -0,0 +1,176 @@
+#frame-time benchmark for the race loop
+#
+#drives the simulation and the race rendering headless (sdl dummy video/audio drivers) with
+#scripted steering and fixed seeds, for every map and difficulty plus stress levels with many
+#more obstacles, and reports frame times per phase and python allocations per frame.
+#
+#  python FrameBenchmark.py --out bench.json
+#  python FrameBenchmark.py --baseline bench.json     # compare against an earlier run
+#
+#run it from the repository root, like the game (asset paths are relative).
+#each case runs run_game's own RaceLoop (ticks, drawing, hud, frame skipping) with no peer.
+#frames are stepped back to back (no frame cap, no real-time wait), ticking the simulation at
+#FPS per RENDER_FPS frames like run_game, so results don't depend on how fast the machine is
+#beyond the work itself.
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tracemalloc
+
+#no window, no sound, and no import banner in the json on stdout
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+os.environ.setdefault("PYGAME_HIDE_SUPPORT_PROMPT", "1")
+
+import pygame
+import ZAYN_Rush_Main_Code as game
+
+STEER_HOLD_TICKS = 15          # scripted drivers keep a steering choice this many ticks
+STRESS_OBSTACLES = [100, 500, 2000]
+WARMUP_FRAMES = 120            # not measured: let the first obstacles come onto the screen
+
+
+#one benchmark case
+
+class RaceBench:
+    """One scripted race through run_game's own RaceLoop: the same ticks, drawing, hud and frame
+    skipping the game does, steered by a scripted driver instead of the keyboard."""
+    def __init__(self, screen, map_id, difficulty, seed, obstacle_count=None):
+        game_map = game.GameMap(map_id)
+        car_paths = list(game.CAR_OPTIONS.values())[:2]
+        self.sim = game.Simulation(map_id, difficulty, seed, role="server", game_map=game_map,
+                                   car_paths=car_paths, obstacle_count=obstacle_count)
+        self.sim.set_mode("p2p")
+        #the race must not end on crashes while it is being measured
+        self.sim.car1.health = self.sim.car2.health = 10**6
+        #with the frame timings overlay on, as with F4 in the game; there is no link to report on
+        self.race = game.RaceLoop(screen, self.sim, game.ScrollingBG(game_map.background),
+                                  show_profiler=True, tick_clock=True)
+        self.driver = random.Random(f"{seed}:{map_id}:{difficulty}:{obstacle_count}")
+        self.steer = 0
+
+    def scripted_steer(self):
+        if self.sim.tick % STEER_HOLD_TICKS == 0:
+            self.steer = self.driver.choice([-1, 0, 1])
+        return self.steer
+
+    def frame(self):
+        """One frame: the ticks due by now, then a render interpolated between the last two."""
+        alpha = self.race.advance(1.0 / game.RENDER_FPS, self.scripted_steer)
+        self.race.frame(alpha)
+        self.sim.profiler.end_frame()
+
+
+def run_case(screen, map_id, difficulty, seed, frames, alloc_frames, obstacle_count=None):
+    """Time `frames` frames of one case, then measure allocations over `alloc_frames` more."""
+    bench = RaceBench(screen, map_id, difficulty, seed, obstacle_count)
+    profiler = game.FrameProfiler()
+    bench.sim.profiler = profiler
+    for _ in range(WARMUP_FRAMES):
+        bench.frame()
+    profiler = game.FrameProfiler(keep_all=True)
+    bench.sim.profiler = profiler
+    for _ in range(frames):
+        bench.frame()
+    totals = sorted(sum(frame) for frame in profiler.frames)
+    phases = profiler.percentiles(profiler.frames)
+    #tracemalloc slows everything down, so allocations get a pass of their own
+    profiler = game.FrameProfiler()
+    bench.sim.profiler = profiler
+    peaks = []
+    tracemalloc.start()
+    retained_from = tracemalloc.get_traced_memory()[0]
+    for _ in range(alloc_frames):
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        bench.frame()
+        peaks.append(tracemalloc.get_traced_memory()[1] - before)
+    retained = tracemalloc.get_traced_memory()[0] - retained_from
+    tracemalloc.stop()
+    return {
+        "map": map_id,
+        "difficulty": difficulty,
+        "obstacles": len(bench.sim.obstacles),
+        "frames": frames,
+        "ticks": bench.sim.tick,
+        "frame_ms": {
+            "mean": round(sum(totals) / len(totals), 3),
+            "p50": round(totals[len(totals) // 2], 3),
+            "p99": round(totals[min(len(totals) - 1, int(len(totals) * 0.99))], 3),
+            "max": round(totals[-1], 3),
+        },
+        "phases_ms": {phase: {"p50": p50, "p99": p99}
+                      for phase, (p50, p99) in phases.items() if phase not in ("idle", "frame")},
+        "alloc_bytes_per_frame": {
+            "mean_peak": round(sum(peaks) / len(peaks)) if peaks else None,
+            "max_peak": max(peaks) if peaks else None,
+            "retained": round(retained / len(peaks)) if peaks else None,
+        },
+    }
+
+def case_name(case):
+    return f"map {case['map']} {case['difficulty']} ({case['obstacles']} obstacles)"
+
+def compare(cases, baseline):
+    """Change in mean and p99 frame time against a previous report, per matching case."""
+    before = {case_name(case): case for case in baseline.get("cases", [])}
+    changes = {}
+    for case in cases:
+        old = before.get(case_name(case))
+        if old is None:
+            continue
+        changes[case_name(case)] = {
+            stat: f"{(case['frame_ms'][stat] - old['frame_ms'][stat]) / old['frame_ms'][stat] * 100:+.1f}%"
+            for stat in ("mean", "p99") if old["frame_ms"][stat]
+        }
+    return changes
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the race loop headless across maps, difficulties and stress levels.")
+    parser.add_argument("--frames", type=int, default=600, help="measured frames per case")
+    parser.add_argument("--alloc-frames", type=int, default=120, help="frames per case traced for allocations")
+    parser.add_argument("--seed", type=int, default=1234, help="match seed for every case")
+    parser.add_argument("--maps", type=int, nargs="*", default=list(game.MAPS), help="map ids to run")
+    parser.add_argument("--stress", type=int, nargs="*", default=STRESS_OBSTACLES,
+                        help="obstacle counts for the stress cases (run on the first map)")
+    parser.add_argument("--baseline", help="earlier report to compare mean/p99 frame times against")
+    parser.add_argument("--out", help="also write the report to this file")
+    args = parser.parse_args()
+
+    pygame.init()
+    screen = pygame.display.set_mode((game.SCREEN_WIDTH, game.SCREEN_HEIGHT))
+    cases = []
+    for map_id in args.maps:
+        for difficulty in game.DIFFICULTY_SETTINGS:
+            cases.append(run_case(screen, map_id, difficulty, args.seed, args.frames, args.alloc_frames))
+    for count in args.stress:
+        case = run_case(screen, args.maps[0], "Catastrophic", args.seed, args.frames, args.alloc_frames, count)
+        case["difficulty"] = f"stress-{count}"
+        cases.append(case)
+    pygame.quit()
+
+    report = {
+        "config": {"frames": args.frames, "alloc_frames": args.alloc_frames, "seed": args.seed,
+                   "fps": game.FPS, "render_fps": game.RENDER_FPS,
+                   "python": sys.version.split()[0], "pygame": pygame.version.ver,
+                   "time": time.strftime("%Y-%m-%d %H:%M:%S")},
+        "cases": cases,
+    }
+    if args.baseline:
+        try:
+            with open(args.baseline) as f:
+                report["vs_baseline"] = compare(cases, json.load(f))
+        except (OSError, ValueError) as e:
+            print(f"Could not read baseline ({args.baseline}): {e}", file=sys.stderr)
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(text)
+
+if __name__ == "__main__":
+    main()
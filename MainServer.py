@@ -1,6 +1,9 @@
 import socket
+import selectors
 import threading
 import time
+import random
+import secrets
 import sqlite3
 import os
 import json
@@ -40,6 +43,17 @@ def init_db():
         cursor.execute("ALTER TABLE users ADD COLUMN games INTEGER DEFAULT 0")
     except Exception:
         pass
+    #create probe results table (one row per player per match) for tuning host selection
+    cursor.execute('''CREATE TABLE IF NOT EXISTS probes (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        match_id INTEGER,
+        player TEXT,
+        rtt_ms REAL,
+        uplink_kbps REAL,
+        cpu_ms REAL,
+        host TEXT,
+        timestamp TEXT
+    )''')
     db.commit()
     db.close()
 
@@ -56,6 +70,17 @@ def log_match(player1, player2):
     db.close()
     return match_id
 
+def log_probes(match_id, results, host):
+    """Store each player's probe result and the host that was picked."""
+    db = sqlite3.connect(DB_PATH, check_same_thread=False)
+    cursor = db.cursor()
+    now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    for player, result in results.items():
+        cursor.execute("INSERT INTO probes (match_id, player, rtt_ms, uplink_kbps, cpu_ms, host, timestamp) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                       (match_id, player, result["rtt_ms"], result["uplink_kbps"], result["cpu_ms"], host, now))
+    db.commit()
+    db.close()
+
 def register_user(username, password, car):
     """Register a new user with preferred car. Returns True if success, False if username exists."""
     db = sqlite3.connect(DB_PATH, check_same_thread=False)
@@ -105,12 +130,213 @@ def get_user_stats(username):
     return None
 
 
+LEGACY_P2P_PORT = 12345  # fixed port older clients listen on when they don't report one
+
+def parse_port(text):
+    """Port reported by a client, or the legacy fixed port if it is missing or invalid."""
+    try:
+        port = int(text)
+    except ValueError:
+        return LEGACY_P2P_PORT
+    return port if 0 < port < 65536 else LEGACY_P2P_PORT
+
 #global variables for online clients
 
 clients = {}           # Map username -> {"conn": connection_socket, "ip": client_ip}
 clients_lock = threading.Lock()
 pending_challenges = {}  # Map challenged_username -> challenger_username
 pending_lock = threading.Lock()
+pending_probes = {}      # Map match_id -> match setup waiting for both probe results
+probes_lock = threading.Lock()
+
+
+#udp relay for matches whose direct p2p path fails (nat, firewall)
+
+RELAY_PORT = 8006
+RELAY_IDLE_TIMEOUT = 30.0    # seconds without traffic before a session is closed
+RELAY_BUFFER_SIZE = 2048     # larger than any datagram the game sends
+TOKEN_PREFIX_LEN = 11        # every game datagram starts with "T,<8 hex token>\n"
+
+class RelaySession:
+    """One match on the relay: the two peer endpoints plus traffic counters."""
+    __slots__ = ("token", "endpoints", "packets", "bytes_in", "bytes_out", "created", "last_seen")
+
+    def __init__(self, token):
+        self.token = token
+        self.endpoints = []    # peer addresses in the order their first datagram arrived
+        self.packets = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.created = self.last_seen = time.monotonic()
+
+relay_sessions = {}   # Map token bytes -> RelaySession, opened by start_match
+relay_routes = {}     # Map peer address -> (RelaySession, other peer's address) once both are known
+public_endpoints = {} # Map username -> public (ip, port) of its p2p socket, learned from REG datagrams
+
+def open_relay_session(token):
+    relay_sessions[token.encode()] = RelaySession(token)
+
+def register_endpoint(buf, n, addr):
+    """REG,<username>[,<secret>] from a player's p2p socket: remember the address its nat maps
+    it to, so the opponent can punch a hole straight to it. Anyone can send a udp datagram, so
+    a player who got a registration secret at login can only be registered with it; an older
+    client without one keeps the first endpoint registered for it until its match starts."""
+    username, _, secret = bytes(buf[4:n]).decode(errors="replace").strip().partition(",")
+    with clients_lock:
+        info = clients.get(username)
+        expected = info.get("reg_secret") if info else None
+    if info is None:
+        return
+    if expected is not None:
+        if not secrets.compare_digest(secret.encode(), expected.encode()):
+            return
+    elif public_endpoints.get(username, addr) != addr:
+        return
+    public_endpoints[username] = addr
+
+def relay_register(buf, n, addr):
+    """Attach a new address to the session named by the datagram's token. Returns its route
+    once both peers have been seen, otherwise None (the datagram is dropped)."""
+    if n < TOKEN_PREFIX_LEN or buf[0:2] != b"T," or buf[TOKEN_PREFIX_LEN - 1] != 10:
+        return None
+    session = relay_sessions.get(bytes(buf[2:TOKEN_PREFIX_LEN - 1]))
+    if session is None:
+        return None  # unknown token: we only relay matches we started
+    if addr not in session.endpoints:
+        if len(session.endpoints) == 2:
+            return None
+        session.endpoints.append(addr)
+        if len(session.endpoints) == 2:
+            first, second = session.endpoints
+            relay_routes[first] = (session, second)
+            relay_routes[second] = (session, first)
+    return relay_routes.get(addr)
+
+def close_idle_relay_sessions(now):
+    for token, session in list(relay_sessions.items()):
+        if now - session.last_seen > RELAY_IDLE_TIMEOUT:
+            relay_sessions.pop(token, None)
+            for addr in session.endpoints:
+                relay_routes.pop(addr, None)
+            if session.packets:
+                duration = max(session.last_seen - session.created, 1e-3)
+                print(f"Relay session {session.token} closed: {session.packets} datagrams, "
+                      f"{session.bytes_in} bytes in, {session.bytes_out} bytes out, "
+                      f"{session.bytes_in / duration:.0f} B/s")
+
+def relay_loop(port=RELAY_PORT):
+    """Forward datagrams between the peers of each session from one selector loop.
+    Datagrams are read into one preallocated buffer and sent straight from it; known
+    addresses are looked up directly, the token is only parsed for new ones."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+    sock.bind(("", port))
+    sock.setblocking(False)
+    selector = selectors.DefaultSelector()
+    selector.register(sock, selectors.EVENT_READ)
+    buf = bytearray(RELAY_BUFFER_SIZE)
+    view = memoryview(buf)
+    next_sweep = time.monotonic() + RELAY_IDLE_TIMEOUT
+    print("Relay is running on udp port", port)
+    while True:
+        selector.select(1.0)
+        now = time.monotonic()
+        #drain everything that is readable before going back to select
+        while True:
+            try:
+                n, addr = sock.recvfrom_into(buf)
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError:
+                continue  # icmp error from a peer that went away
+            route = relay_routes.get(addr)
+            if route is None:
+                if buf[0:4] == b"REG,":
+                    register_endpoint(buf, n, addr)
+                    continue
+                route = relay_register(buf, n, addr)
+                if route is None:
+                    continue
+            session, dest = route
+            try:
+                sent = sock.sendto(view[:n], dest)
+            except OSError:
+                sent = 0  # full buffer or unreachable peer: the datagram is lost, as on a direct path
+            session.packets += 1
+            session.bytes_in += n
+            session.bytes_out += sent
+            session.last_seen = now
+        if now >= next_sweep:
+            close_idle_relay_sessions(now)
+            next_sweep = now + RELAY_IDLE_TIMEOUT
+
+
+#host selection
+
+PROBE_TIMEOUT = 3.0          # seconds to wait for probe results before using the default host
+HOST_BYTES_PER_TICK = 160    # typical host datagram: state, obstacle events/keyframes, acks
+CLIENT_BYTES_PER_TICK = 60   # typical client datagram: state (or inputs) and acks
+UPLINK_CAP_KBPS = 20000      # faster uplinks all count as this; the probe can't tell them apart
+HOST_MARGIN_MS = 1.0         # the challenger only hosts if that is at least this much cheaper
+
+def hosting_cost(host, client):
+    """Rough ms per tick added if `host` hosts: its uplink carries the heavier host traffic,
+    the client's uplink the lighter client traffic, and its cpu runs the obstacle simulation.
+    Only uplink and cpu decide. The probe rtt is each player's link to the lobby, not the
+    link between the peers, and the same path is crossed whoever hosts, so it is only logged."""
+    cost = HOST_BYTES_PER_TICK * 8 / min(host["uplink_kbps"], UPLINK_CAP_KBPS)    # bytes * 8 / kbps = ms
+    cost += CLIENT_BYTES_PER_TICK * 8 / min(client["uplink_kbps"], UPLINK_CAP_KBPS)
+    return cost + host["cpu_ms"]
+
+def pick_host(match):
+    """Return the player who should host, falling back to the responder without both results
+    or when either uplink could not be measured (reported as 0)."""
+    results = match["results"]
+    a, b = match["responder"], match["challenger"]
+    if a not in results or b not in results:
+        return a
+    if results[a]["uplink_kbps"] <= 0 or results[b]["uplink_kbps"] <= 0:
+        return a
+    if hosting_cost(results[b], results[a]) + HOST_MARGIN_MS < hosting_cost(results[a], results[b]):
+        return b
+    return a
+
+def start_match(match, host):
+    """Send MATCH_START to both players with `host` as the p2p server."""
+    client = match["challenger"] if host == match["responder"] else match["responder"]
+    players = match["players"]
+    #shared seed so both peers generate the same obstacle timeline
+    match_seed = random.getrandbits(32)
+    #per-match token in every p2p datagram, so matches sharing a host or nat can't mix;
+    #it also names the match's relay session if the direct path fails
+    match_token = secrets.token_hex(4)
+    open_relay_session(match_token)
+    for me, role, other in ((host, "server", client), (client, "client", host)):
+        opp = players[other]
+        #the opponent's nat-mapped endpoint, if it registered one; both sides punch towards
+        #each other as soon as this arrives, the relay stays the fallback
+        public_ip, public_port = public_endpoints.pop(other, ("", ""))
+        try:
+            #each side gets the other's os-chosen udp port
+            players[me]["conn"].send(f"MATCH_START:{match['match_id']}:{role}:{opp['ip']}:{opp['port']}:{opp['car']}:{other}:{match_seed}:{match_token}:{RELAY_PORT}:{public_ip}:{public_port}\n".encode())
+        except Exception as e:
+            print(f"Error sending match start to {me}:", e)
+            if role == "server":
+                return  # if we fail to notify the host, abort match setup
+
+def finish_probe(match_id):
+    """Pick the host once both probe results are in (or the timeout fired) and start the match."""
+    with probes_lock:
+        match = pending_probes.pop(match_id, None)
+    if match is None:
+        return  # already started
+    host = pick_host(match)
+    if match["results"]:
+        try:
+            log_probes(match_id, match["results"], host)
+        except Exception as e:
+            print("Error logging probe results:", e)
+    start_match(match, host)
 
 
 #client handler function
@@ -120,7 +346,7 @@ def handle_client(conn, addr):
     Handle a new client connection.
     Supports:
       - G: get list of online players
-      - LOGIN:<user>:<pass>
+      - LOGIN:<user>:<pass>[:reg] (with reg, the reply carries the player's udp registration secret)
       - REGISTER:<user>:<pass>:<car>
       Then listens for challenge commands or results.
     """
@@ -164,10 +390,13 @@ def handle_client(conn, addr):
                 username = parts[1]
                 password = parts[2]
                 if login_user(username, password):
-                    conn.send("LOGIN_SUCCESS\n".encode())
-                    #keep this connection open for further communication
+                    #clients that ask get a secret for their REG datagrams (older ones expect the bare reply)
+                    reg_secret = secrets.token_hex(8) if len(parts) >= 4 and parts[3] == "reg" else None
+                    #keep this connection open for further communication (listed before the reply,
+                    #so a REG sent right after it finds the player)
                     with clients_lock:
-                        clients[username] = {"conn": conn, "ip": addr[0]}
+                        clients[username] = {"conn": conn, "ip": addr[0], "reg_secret": reg_secret}
+                    conn.send((f"LOGIN_SUCCESS:{reg_secret}\n" if reg_secret else "LOGIN_SUCCESS\n").encode())
                 else:
                     conn.send("LOGIN_FAILED\n".encode())
                     conn.close()
@@ -213,7 +442,7 @@ def handle_client(conn, addr):
 
             #challenge request
             if data.startswith("CHALLENGE:"):
-                #expected format: challenge:<challenger>:<challenged>
+                #expected format: challenge:<challenger>:<challenged>[:<car>[:<p2p udp port>]]
                 parts = data.split(":")
                 if len(parts) >= 3:
                     challenger = parts[1]
@@ -231,7 +460,9 @@ def handle_client(conn, addr):
                                 conn.send("OPPONENT_NOT_AVAILABLE\n".encode())
                                 continue
                             challenger_car = parts[3] if len(parts) >= 4 else "A"
-                            pending_challenges[challenged] = {"challenger": challenger, "car": challenger_car }
+                            challenger_port = parse_port(parts[4]) if len(parts) >= 5 else LEGACY_P2P_PORT
+                            pending_challenges[challenged] = {"challenger": challenger, "car": challenger_car,
+                                                              "port": challenger_port}
                         try:
                             #forward challenge request to the target
                             target_conn = target_info["conn"]
@@ -249,18 +480,20 @@ def handle_client(conn, addr):
                         conn.send("OPPONENT_NOT_AVAILABLE\n".encode())
 
             elif data.startswith("CHALLENGE_RESPONSE:"):
-                #expected format: challenge_response:<responder>:accept/reject
+                #expected format: challenge_response:<responder>:accept/reject[:<car>[:<p2p udp port>]]
                 parts = data.split(":")
                 if len(parts) >= 3:
                     responder = parts[1]
                     response = parts[2].upper()
                     responder_live_car = parts[3] if len(parts) >= 4 else None
+                    responder_port = parse_port(parts[4]) if len(parts) >= 5 else LEGACY_P2P_PORT
                     challenger = None
                     with pending_lock:
                         info = pending_challenges.pop(responder, None)
                         if info:
                              challenger = info["challenger"]
                              challenger_car = info["car"]
+                             challenger_port = info.get("port", LEGACY_P2P_PORT)
                     if response == "ACCEPT" and challenger:
                         #challenge accepted – set up match
                         with clients_lock:
@@ -275,10 +508,6 @@ def handle_client(conn, addr):
                             continue
                         #log match in history and prepare role assignments
                         match_id = log_match(challenger, responder)
-                        challenger_conn = challenger_info["conn"]
-                        responder_conn = responder_info["conn"]
-                        challenger_ip = challenger_info["ip"]
-                        responder_ip = responder_info["ip"]
                         #retrieve preferred cars for each player
                         challenger_stats = get_user_stats(challenger) or {}
                         responder_stats = get_user_stats(responder) or {}
@@ -287,19 +516,28 @@ def handle_client(conn, addr):
     if responder_live_car else
     responder_stats.get("car", "A") #otherwise fall back to DB
 )
-
-                        try:
-                            #the responder will act as p2p server
-                            responder_conn.send(f"MATCH_START:{match_id}:server:{challenger_ip}:12345:{challenger_car}:{challenger}\n".encode())
-                        except Exception as e:
-                            print("Error sending match start to responder:", e)
-                            continue  # If we fail to notify responder, abort match setup
-                        try:
-                            #the challenger will act as p2p client
-                            challenger_conn.send(f"MATCH_START:{match_id}:client:{responder_ip}:12345:{responder_car}:{responder}\n".encode())
-                        except Exception as e:
-                            print("Error sending match start to challenger:", e)
-                            #even if challenger notification fails, responder was told to wait for connection
+                        match = {
+                            "match_id": match_id,
+                            "challenger": challenger,
+                            "responder": responder,
+                            "players": {
+                                challenger: {"conn": challenger_info["conn"], "ip": challenger_info["ip"],
+                                             "port": challenger_port, "car": challenger_car},
+                                responder: {"conn": responder_info["conn"], "ip": responder_info["ip"],
+                                            "port": responder_port, "car": responder_car},
+                            },
+                            "results": {}
+                        }
+                        #probe both players before picking the host; clients that don't answer
+                        #leave the responder hosting once the timeout fires
+                        with probes_lock:
+                            pending_probes[match_id] = match
+                        threading.Timer(PROBE_TIMEOUT, finish_probe, args=(match_id,)).start()
+                        for player in (challenger, responder):
+                            try:
+                                match["players"][player]["conn"].send(f"PROBE:{match_id}\n".encode())
+                            except Exception as e:
+                                print(f"Error sending probe to {player}:", e)
                     elif response == "REJECT" and challenger:
                         #challenge was declined
                         with clients_lock:
@@ -310,6 +548,32 @@ def handle_client(conn, addr):
                             except Exception:
                                 pass
 
+            elif data.startswith("PROBE_PING:"):
+                #expected format: probe_ping:<match_id>:<n>[:<padding>]; echo only the header
+                #so the padding measures the player's uplink
+                parts = data.split(":")
+                conn.send(f"PROBE_PONG:{':'.join(parts[1:3])}\n".encode())
+
+            elif data.startswith("PROBE_RESULT:"):
+                #expected format: probe_result:<match_id>:<rtt_ms>:<uplink_kbps>:<cpu_ms>
+                #(uplink 0 = not measurable, e.g. on a lan where the padding takes no time)
+                parts = data.split(":")
+                if len(parts) >= 5 and username:
+                    try:
+                        match_id = int(parts[1])
+                        result = {"rtt_ms": float(parts[2]), "uplink_kbps": float(parts[3]), "cpu_ms": float(parts[4])}
+                    except ValueError:
+                        continue
+                    with probes_lock:
+                        match = pending_probes.get(match_id)
+                        if match is not None and username in match["players"]:
+                            match["results"][username] = result
+                            complete = len(match["results"]) == 2
+                        else:
+                            complete = False
+                    if complete:
+                        finish_probe(match_id)
+
             elif data.startswith("RESULT:"):
                 #expected format: result:player1:player2:winner
                 parts = data.split(":")
@@ -392,6 +656,7 @@ def main():
 
     server.bind((HOST, PORT))
     server.listen()
+    threading.Thread(target=relay_loop, daemon=True).start()
     print("Server is running on port", PORT)
     print("Waiting for connections...")
     while True:
@@ -0,0 +1,339 @@
+#network impairment emulator for p2p sync testing
+#
+#runs two headless peers of the match networking (NetworkPump, reliable channel, snapshot buffer,
+#obstacle events) against each other through a local udp proxy that adds latency, jitter, loss,
+#duplication and reordering, then scores how far the two views of the race drifted apart.
+#
+#  python NetworkEmulator.py --latency 80 --jitter 20 --loss 0.05 --duplicate 0.01 --reorder 0.02
+#
+#the peers drive the same Simulation run_game does (obstacle movement, respawns, collisions,
+#obstacle events) and the real NetworkPump, so a sync bug in those shows up here. what they
+#don't run is run_game's own loop: keyboard input, rendering and interpolation, the netcode
+#modes (the peers always play p2p) and the final result exchange, so those need a real race.
+#
+#prints a json report (car and obstacle position error, time to convergence, link telemetry)
+#and exits with status 1 if an obstacle's two views stayed apart longer than --max-convergence-ms
+#(including a divergence still open when the race ended), so it can gate a change
+import os
+import sys
+import json
+import time
+import heapq
+import random
+import socket
+import argparse
+import selectors
+import subprocess
+import tempfile
+
+#the peers never open a window or play sound
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+import ZAYN_Rush_Main_Code as game
+
+EMULATOR_TOKEN = "e5a7c0de"
+CONVERGED_PX = 10          # position error below which two views count as agreeing
+MAX_CONVERGENCE_MS = 1000  # default for how long a divergence may last before the run fails
+STEER_HOLD_TICKS = 15      # scripted drivers keep a steering choice this many ticks
+
+
+#impaired udp proxy
+
+class ImpairedLink:
+    """One direction of the proxy: decides when (and how often) each datagram is delivered."""
+    def __init__(self, latency, jitter, loss, duplicate, reorder, rng):
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.duplicate = duplicate
+        self.reorder = reorder
+        self.rng = rng
+        self.stats = {"in": 0, "dropped": 0, "duplicated": 0, "reordered": 0}
+
+    def delays(self):
+        """Delivery delays in seconds for one datagram: none if it is lost, two if duplicated."""
+        self.stats["in"] += 1
+        if self.rng.random() < self.loss:
+            self.stats["dropped"] += 1
+            return []
+        copies = 1
+        if self.rng.random() < self.duplicate:
+            self.stats["duplicated"] += 1
+            copies = 2
+        delays = []
+        for _ in range(copies):
+            delay = self.latency + self.rng.uniform(-self.jitter, self.jitter)
+            if self.rng.random() < self.reorder:
+                #hold it back long enough for later datagrams to overtake it
+                self.stats["reordered"] += 1
+                delay += self.latency + 0.05
+            delays.append(max(0.0, delay))
+        return delays
+
+class ImpairmentProxy:
+    """Udp proxy between two peers. Each peer sends to its own proxy port; datagrams come out
+    of the other port towards the other peer after passing that direction's ImpairedLink."""
+    def __init__(self, settings, seed):
+        rng = random.Random(seed)
+        self.sockets = []
+        for _ in range(2):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.bind(("127.0.0.1", 0))
+            sock.setblocking(False)
+            self.sockets.append(sock)
+        self.ports = [sock.getsockname()[1] for sock in self.sockets]
+        self.peers = [None, None]      # peer addresses, learned from their first datagram
+        self.links = [ImpairedLink(rng=rng, **settings), ImpairedLink(rng=rng, **settings)]
+        self.queue = []                # (deliver_at, n, data, side)
+        self.counter = 0
+
+    def run(self, duration):
+        selector = selectors.DefaultSelector()
+        for side, sock in enumerate(self.sockets):
+            selector.register(sock, selectors.EVENT_READ, side)
+        deadline = time.monotonic() + duration
+        while time.monotonic() < deadline:
+            timeout = 0.05
+            if self.queue:
+                timeout = max(0.0, min(timeout, self.queue[0][0] - time.monotonic()))
+            for key, _ in selector.select(timeout):
+                side = key.data
+                while True:
+                    try:
+                        data, addr = self.sockets[side].recvfrom(4096)
+                    except (BlockingIOError, InterruptedError):
+                        break
+                    except OSError:
+                        continue
+                    self.peers[side] = addr
+                    now = time.monotonic()
+                    for delay in self.links[side].delays():
+                        self.counter += 1
+                        heapq.heappush(self.queue, (now + delay, self.counter, data, 1 - side))
+            now = time.monotonic()
+            while self.queue and self.queue[0][0] <= now:
+                _, _, data, side = heapq.heappop(self.queue)
+                if self.peers[side] is not None:
+                    try:
+                        self.sockets[side].sendto(data, self.peers[side])
+                    except OSError:
+                        pass
+        selector.close()
+        for sock in self.sockets:
+            sock.close()
+
+
+#headless peer
+
+def run_peer(role, proxy_port, seconds, seed, difficulty, trace_path):
+    """Play one scripted p2p race through the proxy and write a per-tick trace."""
+    is_host = role == "server"
+    shared_timeline = seed is not None
+    match_seed = seed if shared_timeline else random.getrandbits(32)
+    game.network_role = role
+    game.netcode_mode = "p2p"
+    game.peer_clock = game.PeerClock(is_reference=is_host)
+    sim = game.Simulation(1, difficulty, match_seed, role=role, shared_timeline=shared_timeline)
+    game.obstacles = obstacles = sim.obstacles
+    car1, car2 = sim.car1, sim.car2
+    game_map = sim.game_map
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(("127.0.0.1", 0))
+    sock.connect(("127.0.0.1", proxy_port))
+    pump = game.NetworkPump(sock, car1, car2, game_map, token=EMULATOR_TOKEN)
+    if is_host and not shared_timeline:
+        for idx in range(len(obstacles)):
+            game.queue_obstacle_event(idx, obstacles.x[idx], obstacles.y[idx], obstacles.img_index[idx])
+    start_at = game.sync_race_start(pump, is_host, 0.5)
+    game.race_start_at = start_at
+    #like wait_until, without a pygame event queue to keep alive
+    while game.peer_clock.now() < start_at:
+        pump.poll()
+        pump.wait(0.005)
+
+    driver = random.Random(f"{seed}:{role}")
+    steer = 0
+    trace = []
+    tick = 0
+    next_tick = time.monotonic()
+    while game.peer_clock.now() - start_at < seconds:
+        if tick % STEER_HOLD_TICKS == 0:
+            steer = driver.choice([-1, 0, 1])
+        remote_pos = game.remote_snapshots.sample(game.peer_clock.now())
+        if remote_pos:
+            car2.rect.x = round(remote_pos[0])
+            car2.rect.y = round(remote_pos[1])
+            car2.hitbox.center = car2.rect.center
+        for kind, idx in sim.step({"steer": steer}):
+            if kind == "spawn":
+                game.queue_obstacle_event(idx, obstacles.x[idx], obstacles.y[idx], obstacles.img_index[idx],
+                                          obstacles.gen[idx] if shared_timeline else None)
+        xs, ys, gens = (column.tolist() for column in obstacles.positions())
+        trace.append([round(game.peer_clock.now(), 4), car1.rect.x, car2.rect.x,
+                      [list(row) for row in zip(xs, ys, gens)]])
+        pump.poll()
+        tick += 1
+        next_tick += 1.0 / game.FPS
+        #like run_game's frame wait: datagrams are read (and stamped) as they arrive
+        pump.wait(next_tick - time.monotonic())
+    #let the last reliable messages drain before closing
+    deadline = time.monotonic() + 0.5
+    while time.monotonic() < deadline and game.reliable_channel.pending():
+        pump.poll()
+        time.sleep(0.01)
+    pump.close()
+    with open(trace_path, "w") as f:
+        json.dump({"role": role, "trace": trace, "telemetry": pump.telemetry.summary(),
+                   "reliable_sent": game.reliable_channel.sent_count,
+                   "retransmits": game.reliable_channel.retransmit_count}, f)
+
+
+#divergence metrics
+
+def percentile(values, p):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return round(ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))], 2)
+
+def error_stats(errors):
+    return {
+        "mean": round(sum(errors) / len(errors), 2) if errors else None,
+        "p95": percentile(errors, 95),
+        "max": round(max(errors), 2) if errors else None,
+        "within_tolerance": round(sum(1 for e in errors if e < CONVERGED_PX) / len(errors), 4) if errors else None,
+    }
+
+def convergence_times(samples):
+    """Durations (ms) of each stretch where the error stayed at or above the tolerance,
+    and how long the stretch still open at the end of the trace had lasted (0 if none)."""
+    times = []
+    began = None
+    for t, error in samples:
+        if error >= CONVERGED_PX and began is None:
+            began = t
+        elif error < CONVERGED_PX and began is not None:
+            times.append(round((t - began) * 1000))
+            began = None
+    open_ms = round((samples[-1][0] - began) * 1000) if began is not None else 0
+    return times, open_ms
+
+def compare(host, client, max_convergence_ms=MAX_CONVERGENCE_MS):
+    """Line the two traces up by synced time and measure how far each view is from the other side's truth."""
+    host_trace, client_trace = host["trace"], client["trace"]
+    host_times = [row[0] for row in host_trace]
+    car_errors = {"host_view": [], "client_view": []}
+    obstacle_samples = {}
+    j = 0
+    for row in client_trace:
+        t = row[0]
+        #nearest host tick at (or just after) the same synced time
+        while j + 1 < len(host_times) and host_times[j + 1] <= t:
+            j += 1
+        if abs(host_times[j] - t) > 1.0 / game.FPS:
+            continue
+        host_row = host_trace[j]
+        #each side's picture of the other car against where that car really was
+        car_errors["client_view"].append(abs(row[2] - host_row[1]))
+        car_errors["host_view"].append(abs(host_row[2] - row[1]))
+        for idx, (mine, theirs) in enumerate(zip(row[3], host_row[3])):
+            #obstacles move 2 * OBSTACLE_SPEED per tick; correct for the time between the two samples
+            dy = (t - host_row[0]) * game.FPS * 2 * game.OBSTACLE_SPEED
+            error = ((mine[0] - theirs[0]) ** 2 + (mine[1] - theirs[1] - dy) ** 2) ** 0.5
+            obstacle_samples.setdefault(idx, []).append((t, error))
+    obstacle_errors = [error for samples in obstacle_samples.values() for _, error in samples]
+    episodes = []
+    unconverged = []
+    for idx, samples in obstacle_samples.items():
+        times, open_ms = convergence_times(samples)
+        episodes += times
+        if open_ms > max_convergence_ms or any(d > max_convergence_ms for d in times):
+            unconverged.append(idx)
+    return {
+        "car_error_px": {view: error_stats(errors) for view, errors in car_errors.items()},
+        "obstacle_error_px": error_stats(obstacle_errors),
+        "obstacle_convergence_ms": {
+            "episodes": len(episodes),
+            "mean": round(sum(episodes) / len(episodes)) if episodes else None,
+            "p95": percentile(episodes, 95),
+            "max": max(episodes) if episodes else None,
+            "unconverged_obstacles": unconverged,
+            "converged": not unconverged,
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run two headless peers through an impaired local udp link and score their sync.")
+    parser.add_argument("--latency", type=float, default=50, help="one-way delay in ms")
+    parser.add_argument("--jitter", type=float, default=10, help="uniform +/- jitter in ms")
+    parser.add_argument("--loss", type=float, default=0.02, help="drop probability per datagram")
+    parser.add_argument("--duplicate", type=float, default=0.0, help="duplication probability per datagram")
+    parser.add_argument("--reorder", type=float, default=0.0, help="probability a datagram is held back past later ones")
+    parser.add_argument("--seconds", type=float, default=20, help="race length")
+    parser.add_argument("--seed", type=int, default=1234, help="match seed (also seeds the impairments)")
+    parser.add_argument("--no-shared-seed", action="store_true", help="legacy mode: the host owns every obstacle respawn")
+    parser.add_argument("--difficulty", default="Easy", choices=list(game.DIFFICULTY_SETTINGS), help="sets health and obstacle count")
+    parser.add_argument("--max-convergence-ms", type=float, default=MAX_CONVERGENCE_MS,
+                        help="fail if an obstacle's views disagree for longer than this")
+    parser.add_argument("--out", help="also write the report to this file")
+    #internal: run one peer
+    parser.add_argument("--peer", choices=["server", "client"], help=argparse.SUPPRESS)
+    parser.add_argument("--proxy-port", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--trace", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.peer:
+        run_peer(args.peer, args.proxy_port, args.seconds, None if args.no_shared_seed else args.seed,
+                 args.difficulty, args.trace)
+        return
+
+    settings = {"latency": args.latency / 1000, "jitter": args.jitter / 1000, "loss": args.loss,
+                "duplicate": args.duplicate, "reorder": args.reorder}
+    proxy = ImpairmentProxy(settings, args.seed)
+    tmp = tempfile.mkdtemp(prefix="zayn_emu_")
+    traces = {role: os.path.join(tmp, f"{role}.json") for role in ("server", "client")}
+    peers = []
+    for side, role in enumerate(("server", "client")):
+        cmd = [sys.executable, os.path.abspath(__file__), "--peer", role, "--proxy-port", str(proxy.ports[side]),
+               "--trace", traces[role], "--seconds", str(args.seconds), "--seed", str(args.seed),
+               "--difficulty", args.difficulty]
+        if args.no_shared_seed:
+            cmd.append("--no-shared-seed")
+        peers.append(subprocess.Popen(cmd))
+    #sync, countdown and drain on top of the race itself
+    proxy.run(args.seconds + game.CLOCK_SYNC_TIME * 2 + 6)
+    for peer in peers:
+        peer.wait()
+    try:
+        with open(traces["server"]) as f:
+            host = json.load(f)
+        with open(traces["client"]) as f:
+            client = json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"A peer did not finish: {e}")
+        sys.exit(1)
+    report = {
+        "impairment": {"latency_ms": args.latency, "jitter_ms": args.jitter, "loss": args.loss,
+                       "duplicate": args.duplicate, "reorder": args.reorder},
+        "shared_seed": not args.no_shared_seed,
+        "proxy": {"host_to_client": proxy.links[0].stats, "client_to_host": proxy.links[1].stats},
+        **compare(host, client, args.max_convergence_ms),
+        "telemetry": {"host": host["telemetry"], "client": client["telemetry"]},
+        "retransmits": {"host": host["retransmits"], "client": client["retransmits"]},
+    }
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(text)
+    convergence = report["obstacle_convergence_ms"]
+    if not convergence["converged"]:
+        print(f"Obstacle views did not converge within {args.max_convergence_ms:.0f} ms: {convergence['unconverged_obstacles']}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,11 @@
-import sys, time, random, threading, socket, pygame, os, json
+import sys, time, random, threading, socket, selectors, pygame, os, json, zlib
+import numpy as np
+from collections import deque, OrderedDict
+from bisect import bisect_left, bisect_right, insort
 from PyQt5.QtWidgets import (
     QApplication, QWidget, QTabWidget,
     QVBoxLayout, QHBoxLayout, QFormLayout, QGridLayout,
-    QLineEdit, QComboBox, QPushButton,
+    QLineEdit, QComboBox, QPushButton, QCheckBox,
     QTableWidget, QTableWidgetItem,
     QLabel, QMessageBox, QDialog, QDialogButtonBox
 )
@@ -162,7 +165,11 @@ class LoginDialog(QDialog):
 
 SCREEN_WIDTH = 800
 SCREEN_HEIGHT = 600
-FPS = 30
+FPS = 30             # simulation and network tick rate
+RENDER_FPS = 120     # default render cap; frames between ticks are interpolated (0 = uncapped)
+MAX_FRAME_TIME = 0.25  # longest frame the fixed-step loop catches up on
+OBSTACLE_SPEED = 5   # obstacles move 2*speed pixels per frame
+STEER_SPEED = 7      # car moves this many pixels per frame while an arrow key is held
 
 #per-map lane boundaries (each map's lane_left and lane_right).
 #adjust these values for each map to change road width boundaries.
@@ -194,6 +201,13 @@ YOU_WON_IMAGE_PATH  = r"resources/endgame/you won.png"
 YOU_LOST_IMAGE_PATH = r"resources/endgame/you lose.png"
 #
 
+#sound & effect paths
+GAME_MUSIC_PATH = r"resources/Sound Effects/Game Music.mp3"
+CRASH_SOUND_PATH = r"resources/Sound Effects/Crash Sound.mp3"
+COUNTDOWN_SOUND_PATH = r"resources/Sound Effects/Countdown.mp3"
+EXPLOSION_IMAGE_PATH = r"resources/Obstacles/BOOM.png"
+EXPLOSION_SIZE = (50, 50)
+
 
 DIFFICULTY_SETTINGS = {
     "Easy":    {"health": 5, "obstacle_multiplier": 1},
@@ -245,6 +259,22 @@ MAPS = {
     }
 }
 
+#netcode modes offered in the setup ui; the host's choice is used for the match
+NETCODE_MODES = {
+    "Peer-to-peer": "p2p",                  # each side simulates its own car
+    "Host authoritative": "authoritative",  # host simulates both cars, client predicts
+    "Lockstep": "lockstep"                  # both simulate everything from exchanged inputs
+}
+
+#render rates offered in the setup ui; the simulation ticks at FPS whichever is picked
+RENDER_RATES = {
+    "120 FPS": 120,
+    "60 FPS": 60,
+    "144 FPS": 144,
+    "240 FPS": 240,
+    "Uncapped": 0
+}
+
 CAR_OPTIONS = {
     "Red": r"resources/CARS/car 1.png",
     "Pink": r"resources/CARS/car 2.png",
@@ -256,41 +286,172 @@ CAR_OPTIONS = {
 #helper class for infinite scrolling background
 
 class ScrollingBG:
+    """Endless vertical scroll drawn from the one background surface: each frame blits just
+    the two pieces of it that are on screen, the bottom piece wrapped round to the top."""
     def __init__(self, surface):
-        self.images = [surface.copy(), surface.copy()]
-        self.y = [0, -SCREEN_HEIGHT]
+        self.image = surface
+        self.y = 0  # how far the image has scrolled down, 0 .. SCREEN_HEIGHT-1
+
+    def scroll(self, speed=5):
+        """Advance one simulation tick."""
+        self.y = (self.y + 2*speed) % SCREEN_HEIGHT
+
+    def position(self, offset=0):
+        """Pixel scroll position plus `offset` pixels of motion towards the next tick."""
+        return int(self.y + offset) % SCREEN_HEIGHT
+
+    def draw(self, target, offset=0):
+        """Draw the current scroll position, plus `offset` pixels of motion towards the next tick."""
+        y = self.position(offset)
+        if y:
+            target.blit(self.image, (0, 0), (0, SCREEN_HEIGHT - y, SCREEN_WIDTH, y))
+        target.blit(self.image, (0, y), (0, 0, SCREEN_WIDTH, SCREEN_HEIGHT - y))
+
+
+#helper class for hud text
+
+class CachedText:
+    """A line of text rendered once and reused until the string changes."""
+    def __init__(self, font, color=WHITE):
+        self.font = font
+        self.color = color
+        self.text = None
+        self.surface = None
+
+    def render(self, text):
+        if text != self.text:
+            self.text = text
+            self.surface = self.font.render(text, True, self.color)
+        return self.surface
+
+
+#asset cache
+
+ASSET_CACHE_SIZE = 64  # decoded images and sounds kept across races
+
+class AssetCache:
+    """Process-wide cache of decoded assets, so a rematch doesn't decode and rescale every image
+    and sound again. Images are keyed by (path, size, alpha), sounds by path, and the least
+    recently used entries are dropped past `capacity`. Cached surfaces are shared: draw them,
+    never draw on them.
+    Decoding and scaling work without a window, so preload() does them on a background thread
+    while the lobby is open. Converting to the display's pixel format needs the window, so
+    image() does that on first use in the game and caches the converted surface instead."""
+    def __init__(self, capacity=ASSET_CACHE_SIZE):
+        self.capacity = capacity
+        self.entries = OrderedDict()  # key -> (asset, converted)
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+            return entry
+
+    def put(self, key, entry, replace=True):
+        """Store `entry` (with replace=False, keep one another thread stored first); returns what is stored."""
+        with self.lock:
+            if replace or key not in self.entries:
+                self.entries[key] = entry
+            self.entries.move_to_end(key)
+            entry = self.entries[key]
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+            return entry
+
+    def decode(self, path, size, alpha):
+        """Load and scale an image without converting it (safe off the main thread)."""
+        key = ("image", path, size, alpha)
+        entry = self.get(key)
+        if entry is None:
+            surface = pygame.image.load(path)
+            if size is not None:
+                surface = pygame.transform.scale(surface, size)
+            entry = self.put(key, (surface, False), replace=False)
+        return entry
+
+    def image(self, path, size=None, alpha=True):
+        """The image at `path` scaled to `size`, converted for the current display."""
+        surface, converted = self.decode(path, size, alpha)
+        if not converted:
+            surface = surface.convert_alpha() if alpha else surface.convert()
+            self.put(("image", path, size, alpha), (surface, True))
+        return surface
+
+    def sound(self, path):
+        key = ("sound", path)
+        entry = self.get(key)
+        if entry is None:
+            entry = self.put(key, (pygame.mixer.Sound(path), True), replace=False)
+        return entry[0]
+
+    def preload(self, images, sounds):
+        """Decode `images` ((path, size, alpha) each) and `sounds` on a daemon thread."""
+        def work():
+            for path, size, alpha in images:
+                try:
+                    self.decode(path, size, alpha)
+                except (pygame.error, OSError) as e:
+                    print(f"Could not preload {path}: {e}")
+            if pygame.mixer.get_init():
+                for path in sounds:
+                    try:
+                        self.sound(path)
+                    except (pygame.error, OSError) as e:
+                        print(f"Could not preload {path}: {e}")
+        threading.Thread(target=work, daemon=True).start()
 
-    def draw(self, target, speed=5):
-        for i in (0, 1):
-            target.blit(self.images[i], (0, self.y[i]))
-            self.y[i] += 2*speed
-            #wrap image to create infinite scroll
-            if self.y[i] >= SCREEN_HEIGHT:
-                self.y[i] = -SCREEN_HEIGHT
+asset_cache = AssetCache()
+
+def preload_game_assets():
+    """Warm the asset cache with everything a race loads, while the player is still in the lobby.
+    The mixer is opened here (and kept open between races) so sounds can be decoded ahead too."""
+    try:
+        pygame.mixer.init()
+    except pygame.error as e:
+        print(f"Audio unavailable, sounds will load at race start: {e}")
+    images = [(EXPLOSION_IMAGE_PATH, EXPLOSION_SIZE, True)]
+    images += [(path, (CAR_W, CAR_H), True) for path in CAR_OPTIONS.values()]
+    for map_info in MAPS.values():
+        images.append((map_info["background"], (SCREEN_WIDTH, SCREEN_HEIGHT), False))
+        images += [(path, (OBST_W, OBST_H), True) for path in map_info["obstacles"]]
+    images += [(path, (SCREEN_WIDTH, SCREEN_HEIGHT), False)
+               for path in (GAME_END_IMAGE_PATH, YOU_WON_IMAGE_PATH, YOU_LOST_IMAGE_PATH)]
+    asset_cache.preload(images, [CRASH_SOUND_PATH, COUNTDOWN_SOUND_PATH])
 
 
 #game classes (pygame)
 
 class GameMap:
-    """Loads map background and obstacle images for a given map ID."""
+    """Loads map background and obstacle images for a given map ID.
+    obstacle_images is the map's sprite table: one shared, read-only surface per sprite, never
+    copied or drawn on. Obstacles (and the messages that sync them) refer to a sprite only by
+    its index into this table. obstacle_masks holds each sprite's collision mask, built once here."""
     def __init__(self, map_id):
         self.map_id = map_id
-        self.background = pygame.transform.scale(
-            pygame.image.load(MAPS[map_id]["background"]).convert(),
-            (SCREEN_WIDTH, SCREEN_HEIGHT))
-        self.obstacle_images = [
-            pygame.transform.scale(pygame.image.load(img).convert_alpha(), (OBST_W, OBST_H))
+        self.background = asset_cache.image(MAPS[map_id]["background"], (SCREEN_WIDTH, SCREEN_HEIGHT), alpha=False)
+        self.obstacle_images = tuple(
+            asset_cache.image(img, (OBST_W, OBST_H))
             for img in MAPS[map_id]["obstacles"]
-        ]
+        )
+        self.obstacle_masks = tuple(pygame.mask.from_surface(img) for img in self.obstacle_images)
         #note: lane boundaries are configured per map in run_game using map_lane_limits
 
 class Car:
-    """Represents a player's car in the game."""
-    def __init__(self, lane, car_image_path):
+    """Represents a player's car in the game (without an image path it has no sprite, for headless runs)."""
+    def __init__(self, lane, car_image_path=None):
         self.lane = lane
-        image = pygame.image.load(car_image_path).convert_alpha()
-        self.image = pygame.transform.scale(image, (CAR_W, CAR_H))
-        self.rect = self.image.get_rect()
+        self.mask = None
+        if car_image_path:
+            self.image = asset_cache.image(car_image_path, (CAR_W, CAR_H))
+            #collision mask: the car's own pixels inside the (centered) hitbox
+            self.mask = pygame.mask.Mask((HITBOX_W, HITBOX_H))
+            self.mask.draw(pygame.mask.from_surface(self.image),
+                           (HITBOX_W // 2 - CAR_W // 2, HITBOX_H // 2 - CAR_H // 2))
+        else:
+            self.image = None
+        self.rect = pygame.Rect(0, 0, CAR_W, CAR_H)
         #position car at bottom of its lane (0 = left lane, 1 = right lane)
         self.rect.x = LANE_LEFT + lane * LANE_WIDTH + LANE_WIDTH // 2 - self.rect.width // 2
         self.rect.y = SCREEN_HEIGHT - self.rect.height - 10
@@ -303,134 +464,1022 @@ class Car:
         self.rect.x = min(max(self.rect.x + dx, ROAD_LEFT), ROAD_RIGHT)
         self.hitbox.center = self.rect.center
 
-    def draw(self, surface):
-        surface.blit(self.image, self.rect)
-
-class Obstacle:
-    """Represents an obstacle on the road."""
-    def __init__(self, image, lane=None, x=None, y=None):
-        #image is expected to be a pre-scaled surface
-        self.image = image.copy()
-        self.rect = self.image.get_rect()
-        if x is not None and y is not None:
-            #initialize obstacle at specified coordinates (for synced events)
-            self.rect.x = x
-            self.rect.y = y
-        elif lane is not None:
-            #place obstacle in specified lane at a random horizontal position within lane, and random spawn height above screen
-            if lane == 0:
-                lane_min = LANE_LEFT
-                lane_max = LANE_LEFT + LANE_WIDTH - self.rect.width
-            else:
-                lane_min = LANE_LEFT + LANE_WIDTH
-                lane_max = LANE_RIGHT - self.rect.width
-            self.rect.x = random.randint(lane_min, lane_max)
-            self.rect.y = random.randint(-SCREEN_HEIGHT, -50)
-        else:
-            #default position if no parameters given
-            self.rect.x = LANE_LEFT
-            self.rect.y = -50
+    def draw(self, surface, pos=None):
+        """Draw at the car's position, or at `pos` (an interpolated render position)."""
+        surface.blit(self.image, self.rect if pos is None else pos)
+
+class ObstaclePool:
+    """Every obstacle of a race as columns (x, y, lane, img_index, gen), one row per obstacle.
+    Movement runs over all rows at once; only the rows that actually respawn drop back to
+    python for their seeded rolls. Rows are never removed, so an obstacle's index is stable
+    for the whole race (the network refers to obstacles by index).
+
+    Each lane also keeps a list of (key, index) sorted by y, so off-screen, hit and spawn-slot
+    queries bisect to the few obstacles near a given height instead of testing every row.
+    Keys are y minus the distance everything has scrolled, so moving all obstacles together
+    leaves the lists untouched; only place() (a respawn or a correction) re-files a row.
+    x and y must therefore be changed through place(), never written directly."""
+    def __init__(self, capacity=32):
+        self.count = 0
+        self.x = np.zeros(capacity, dtype=np.int32)
+        self.y = np.zeros(capacity, dtype=np.int32)
+        self.lane = np.zeros(capacity, dtype=np.int8)          # follows x, see lane_of()
+        self.img_index = np.zeros(capacity, dtype=np.int32)  # index into the map's obstacle images
+        self.gen = np.zeros(capacity, dtype=np.int32)        # bumped on every respawn so peers can order updates
+        self.split = LANE_LEFT + LANE_WIDTH  # first x of the right lane
+        self.scroll = 0                      # total distance moved so far
+        self.lanes = ([], [])                # per lane: sorted (y - scroll, index)
+
+    def __len__(self):
+        return self.count
+
+    def lane_of(self, x):
+        return 0 if x < self.split else 1
+
+    def append(self, x, y, img_index=0):
+        """Add an obstacle at (x, y) and return its index."""
+        if self.count == len(self.x):
+            #out of room: double every column
+            size = max(2 * len(self.x), 1)
+            for name in ("x", "y", "lane", "img_index", "gen"):
+                column = getattr(self, name)
+                grown = np.zeros(size, dtype=column.dtype)
+                grown[:self.count] = column[:self.count]
+                setattr(self, name, grown)
+        idx = self.count
+        self.img_index[idx] = img_index
+        self.gen[idx] = 0
+        self.count += 1
+        self.file(idx, x, y)
+        return idx
+
+    def file(self, idx, x, y):
+        """Set a row's position and enter it in its lane's sorted list."""
+        lane = self.lane_of(x)
+        self.x[idx] = x
+        self.y[idx] = y
+        self.lane[idx] = lane
+        insort(self.lanes[lane], (y - self.scroll, idx))
+
+    def place(self, idx, x, y):
+        """Move one obstacle to (x, y), re-filing it under its new lane and height."""
+        bucket = self.lanes[self.lane[idx]]
+        del bucket[bisect_left(bucket, (int(self.y[idx]) - self.scroll, idx))]
+        self.file(idx, int(x), int(y))
 
     def move(self, dy):
-        """Move obstacle vertically down the screen."""
-        self.rect.y += 2*dy
-
-    def draw(self, surface):
-        surface.blit(self.image, self.rect)
+        """Move every obstacle vertically down the screen."""
+        self.y[:self.count] += 2*dy
+        self.scroll += 2*dy
+
+    def between(self, lane, top, bottom):
+        """(key, index) entries of a lane with top < y < bottom."""
+        bucket = self.lanes[lane]
+        start = bisect_right(bucket, (top - self.scroll, sys.maxsize))
+        return bucket[start:bisect_left(bucket, (bottom - self.scroll, -1), start)]
+
+    def below(self, y):
+        """Indices of the obstacles whose top edge is below `y` (off the bottom of the screen)."""
+        return sorted(idx for lane in (0, 1) for _, idx in self.between(lane, y, sys.maxsize))
+
+    def hits(self, rect, sprite_masks=None, mask=None):
+        """Indices of the obstacles overlapping `rect` (same test as Rect.colliderect).
+        With sprite_masks (one per sprite) and `mask` (covering rect), the rect overlaps are
+        only the broad phase: a hit also needs an opaque pixel of each to overlap."""
+        found = []
+        for lane in (0, 1):
+            #left-lane obstacles start left of the split, right-lane ones at or after it
+            if (lane == 0 and rect.left >= self.split + OBST_W) or (lane == 1 and rect.right <= self.split):
+                continue
+            rows = np.array([idx for _, idx in self.between(lane, rect.top - OBST_H, rect.bottom)], dtype=np.intp)
+            x = self.x[rows]
+            found += rows[(x < rect.right) & (x + OBST_W > rect.left)].tolist()
+        if sprite_masks is not None and mask is not None:
+            found = [idx for idx in found if sprite_masks[self.img_index[idx]].overlap(
+                mask, (rect.x - int(self.x[idx]), rect.y - int(self.y[idx])))]
+        return sorted(found)
+
+    def slot_free(self, x, y):
+        """Spawn check: no other obstacle in x's lane within one obstacle height of y
+        (one at exactly the same x is allowed)."""
+        for _, idx in self.between(self.lane_of(x), y - OBST_H, y + OBST_H):
+            if self.x[idx] != x:
+                return False
+        return True
+
+    def positions(self):
+        """Copies of the x, y and gen columns, for interpolating the next frame from."""
+        return (self.x[:self.count].copy(), self.y[:self.count].copy(), self.gen[:self.count].copy())
+
+    def draw(self, surface, images, prev=None, alpha=1.0):
+        """Draw the on-screen obstacles from the sprite table `images`, alpha of the way from
+        `prev` (positions()) to now.
+        Obstacles that respawned or were corrected since `prev` are drawn where they are."""
+        n = self.count
+        x, y = self.x[:n], self.y[:n]
+        draw_x = x.astype(float)
+        draw_y = y.astype(float)
+        if prev is not None:
+            prev_x, prev_y, prev_gen = prev
+            m = min(len(prev_x), n)  # rows added since prev have nothing to interpolate from
+            dy = y[:m] - prev_y[:m]
+            smooth = (prev_gen[:m] == self.gen[:m]) & (dy >= 0) & (dy <= 4 * OBSTACLE_SPEED)
+            draw_x[:m] = np.where(smooth, prev_x[:m] + (x[:m] - prev_x[:m]) * alpha, x[:m])
+            draw_y[:m] = np.where(smooth, prev_y[:m] + dy * alpha, y[:m])
+        #only draw obstacles that are on screen
+        visible = np.flatnonzero(y < SCREEN_HEIGHT)
+        sprites = self.img_index[visible].tolist()
+        surface.blits([(images[sprite], (px, py)) for sprite, px, py in
+                       zip(sprites, draw_x[visible].tolist(), draw_y[visible].tolist())], False)
+
+
+def obstacle_rng(seed, idx, gen):
+    """PRNG for one obstacle generation; both peers roll the same spawn from the same match seed."""
+    return random.Random(f"{seed}:{idx}:{gen}")
+
+def lane_span(lane):
+    """Range of x positions an obstacle can take inside a lane."""
+    if lane == 0:
+        return LANE_LEFT, LANE_LEFT + LANE_WIDTH - OBST_W
+    return LANE_LEFT + LANE_WIDTH, LANE_RIGHT - OBST_W
+
+def respawn_obstacle(obstacles, idx, game_map, seed):
+    """Recycle obstacle `idx` to its next spawn above the screen, derived only from (seed, idx, gen)."""
+    gen = int(obstacles.gen[idx]) + 1
+    rng = obstacle_rng(seed, idx, gen)
+    lane_min, lane_max = lane_span(rng.choice([0, 1]))
+    obstacles.gen[idx] = gen
+    obstacles.place(idx, rng.randint(lane_min, lane_max), rng.randint(-SCREEN_HEIGHT, -50))
+    #randomly choose a new obstacle image from current map set
+    obstacles.img_index[idx] = rng.randrange(len(game_map.obstacle_images))
 
 
 #p2p networking 
 
 running_network = False
-#set up global variables for network role and event queue
+#set up global variables for network role and reliable channel
 network_role = None
-events_queue = []  # queue of obstacle events to send (for host)
-
-def p2p_send_thread(peer_socket, local_car):
-    """Continuously send local car's position, health, and any new obstacle events to the peer."""
-    global running_network
-    #determine if this side is host (server) for sending obstacle data
-    is_host = (network_role == "server")
-    while running_network:
+MAX_DATAGRAM = 1200          # keep each udp payload under a typical mtu
+remote_final_health = None   # opponent's health as reported in its final result message
+race_start_at = None         # race start instant in synced time, scheduled by the host
+remote_final_view = None     # authoritative host's final health for our car
+collision_spawns_sent = {}   # obstacle index -> (gen, synced ms) of the last collision respawn we sent
+CLOCK_SYNC_TIME = 1.0        # seconds of ping/pong before the host schedules the start
+
+#wire format: one datagram holds several newline-terminated lines, each tagged by its first field
+#  S,x=..,y=..,h=..,t=ms  car state (unreliable, latest wins); deltas carry only the changed fields,
+#                       t is the synced clock in milliseconds when the state was taken
+#  R,seq,<message>      reliable message, acked by the receiver and retransmitted until then
+#  A,seq,seq,...        acks for reliable messages
+#  P,t0 / Q,t0,t1,t2    clock sync ping and pong (ms)
+#  I,seq,d,d,...        authoritative client inputs, newest first (-1 left, 0 none, 1 right)
+#  O,t,index:x:y:imgindex:gen,...  authoritative host's periodic obstacle keyframe
+#  L,tick,ack,d,d,...   lockstep inputs from `tick` backwards, plus the last tick we hold all peer inputs for
+#  T,token              first line of every datagram when the lobby handed out a match token
+#  D,seq,t              datagram sequence number and synced send time (ms), for link telemetry
+#  N                    hole punching packet, otherwise ignored
+#the authoritative host's S line also carries a= (last client input applied), cx=, ch= (client car)
+#reliable messages: E,index:x:y:imgindex[:gen],t (obstacle event), F,health[,your_health] (final result),
+#                   G,t,mode,delay (race start instant, netcode mode and lockstep input delay, host -> client),
+#                   H,tick,crc (lockstep state hash)
+
+class PeerClock:
+    """NTP-style estimate of the offset to the peer's clock over the p2p channel.
+    The host is the reference (offset stays 0); the client adds the offset from its
+    lowest-RTT ping so both sides read the same synced time from now()."""
+    def __init__(self, is_reference=True):
+        self.is_reference = is_reference
+        self.offset = 0.0
+        self.best_rtt = None
+        self.rtt = None            # smoothed round-trip time over all pongs
+
+    def local(self):
+        return time.monotonic()
+
+    def now(self):
+        """Synced time in seconds."""
+        return time.monotonic() + self.offset
+
+    def synced(self, local_t):
+        """Synced time of an instant read earlier from local()."""
+        return local_t + self.offset
+
+    def on_pong(self, t0, t1, t2, t3):
+        """t0/t3: our send/receive times, t1/t2: peer's receive/send times (seconds)."""
+        rtt = (t3 - t0) - (t2 - t1)
+        self.rtt = rtt if self.rtt is None else 0.875 * self.rtt + 0.125 * rtt
+        #the fastest exchange has the least queuing asymmetry, so trust its offset
+        if self.best_rtt is None or rtt <= self.best_rtt:
+            self.best_rtt = rtt
+            if not self.is_reference:
+                self.offset = ((t1 - t0) + (t2 - t3)) / 2
+
+peer_clock = PeerClock()
+
+class ReliableChannel:
+    """Sequence numbers, acks and retransmission for critical messages on the p2p socket.
+    Messages are delivered as they arrive (no head-of-line blocking); a message queued with a
+    key replaces any unacked message with the same key, so superseded updates are never resent."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.next_seq = 1
+        self.unacked = {}          # seq -> [message, key, last_sent (0 = never), first_sent]
+        self.by_key = {}           # key -> seq of its newest unacked message
+        self.acks_to_send = []
+        self.delivered_upto = 0    # every seq <= this has been delivered
+        self.delivered_ahead = set()
+        self.srtt = None           # smoothed round-trip time from acked messages
+        self.sent_count = 0
+        self.retransmit_count = 0
+
+    def send(self, message, key=None):
+        """Queue a message for reliable delivery."""
+        with self.lock:
+            if key is not None and key in self.by_key:
+                self.unacked.pop(self.by_key[key], None)
+            seq = self.next_seq
+            self.next_seq += 1
+            self.unacked[seq] = [message, key, 0, 0]
+            if key is not None:
+                self.by_key[key] = seq
+
+    def retransmit_timeout(self):
+        #wait a bit more than one round trip (plus the peer's send interval) before resending
+        if self.srtt is None:
+            return 0.2
+        return min(max(2 * self.srtt, 0.06), 1.0)
+
+    def outgoing(self, budget, now):
+        """Return the ack line and as many due reliable lines as fit in `budget` bytes, oldest first."""
+        lines = []
+        with self.lock:
+            if self.acks_to_send:
+                acks = self.acks_to_send
+                self.acks_to_send = []
+                line = "A," + ",".join(str(seq) for seq in acks)
+                while len(line) + 1 > budget and len(acks) > 1:
+                    #leave the rest for the next datagram
+                    self.acks_to_send.extend(acks[len(acks) // 2:])
+                    acks = acks[:len(acks) // 2]
+                    line = "A," + ",".join(str(seq) for seq in acks)
+                lines.append(line)
+                budget -= len(line) + 1
+            rto = self.retransmit_timeout()
+            for seq, entry in self.unacked.items():
+                if entry[2] and now - entry[2] < rto:
+                    continue  # in flight, not due yet
+                line = f"R,{seq},{entry[0]}"
+                if len(line) + 1 > budget:
+                    break  # the rest goes out with the next send
+                budget -= len(line) + 1
+                if entry[2]:
+                    self.retransmit_count += 1
+                else:
+                    entry[3] = now
+                self.sent_count += 1
+                entry[2] = now
+                lines.append(line)
+        return lines
+
+    def on_ack(self, seqs, now):
+        with self.lock:
+            for seq in seqs:
+                entry = self.unacked.pop(seq, None)
+                if entry is None:
+                    continue  # duplicate ack or superseded message
+                if entry[1] is not None and self.by_key.get(entry[1]) == seq:
+                    del self.by_key[entry[1]]
+                if entry[2] == entry[3]:
+                    #only sample messages that were sent once, so the ack can't belong to a resend
+                    sample = now - entry[3]
+                    self.srtt = sample if self.srtt is None else 0.875 * self.srtt + 0.125 * sample
+
+    def on_reliable(self, seq):
+        """Record an incoming reliable seq. Returns True the first time it is seen."""
+        with self.lock:
+            self.acks_to_send.append(seq)  # always ack, the previous ack may have been lost
+            if seq <= self.delivered_upto or seq in self.delivered_ahead:
+                return False
+            self.delivered_ahead.add(seq)
+            while self.delivered_upto + 1 in self.delivered_ahead:
+                self.delivered_upto += 1
+                self.delivered_ahead.remove(self.delivered_upto)
+            return True
+
+    def pending(self):
+        with self.lock:
+            return len(self.unacked)
+
+reliable_channel = ReliableChannel()
+
+
+class SendScheduler:
+    """Decides on each game tick whether to send the local car state and which fields changed.
+    Sends every tick while steering, backs off when idle or when the link degrades, and sends a
+    full keyframe every KEYFRAME_TICKS so a lost delta never leaves the peer stale for long."""
+    KEYFRAME_TICKS = 30       # one full state per second at 30 ticks/s
+    STEER_INTERVAL = 1        # ticks between sends while the car is moving
+    IDLE_INTERVAL = 3         # ticks between sends while nothing changes
+    MAX_BACKOFF = 4
+
+    def __init__(self):
+        self.tick = 0
+        self.last_send_tick = -self.KEYFRAME_TICKS
+        self.last_keyframe_tick = -self.KEYFRAME_TICKS
+        self.sent_fields = {}     # field -> value the peer last received from us
+        self.last_x = None
+        self.idle_ticks = 0       # ticks since the car last moved
+        self.backoff = 1          # link-quality multiplier on the send interval
+        self.seen_sent = 0
+        self.seen_retransmits = 0
+
+    def update_link_quality(self, channel):
+        """Adjust the backoff from the reliable channel's retransmit ratio and smoothed RTT."""
+        sent = channel.sent_count - self.seen_sent
+        if sent < 10:
+            return  # not enough samples since the last check
+        loss = (channel.retransmit_count - self.seen_retransmits) / sent
+        self.seen_sent = channel.sent_count
+        self.seen_retransmits = channel.retransmit_count
+        rtt = channel.srtt or 0
+        if loss > 0.2 or rtt > 0.3:
+            self.backoff = min(self.backoff * 2, self.MAX_BACKOFF)
+        elif loss < 0.05 and rtt < 0.15:
+            self.backoff = max(self.backoff // 2, 1)
+
+    def next_state(self, fields, stamp, always=()):
+        """Advance one tick and return the state line to send for `fields` taken at `stamp` (ms), or None to skip.
+        Fields named in `always` are sent with every state line that goes out."""
+        self.tick += 1
+        if fields["x"] != self.last_x:
+            self.idle_ticks = 0
+            self.last_x = fields["x"]
+        else:
+            self.idle_ticks += 1
+        interval = self.STEER_INTERVAL if self.idle_ticks < 5 else self.IDLE_INTERVAL
+        keyframe = self.tick - self.last_keyframe_tick >= self.KEYFRAME_TICKS
+        #health changes go out right away, they decide the race
+        due = (keyframe or self.tick - self.last_send_tick >= interval * self.backoff
+               or fields["h"] != self.sent_fields.get("h"))
+        if not due:
+            return None
+        if keyframe:
+            changed = fields
+            self.last_keyframe_tick = self.tick
+        else:
+            changed = {k: v for k, v in fields.items() if k in always or self.sent_fields.get(k) != v}
+            if not changed:
+                return None
+        self.sent_fields.update(changed)
+        self.last_send_tick = self.tick
+        return "S," + ",".join(f"{k}={v}" for k, v in changed.items()) + f",t={stamp}"
+
+
+class SnapshotBuffer:
+    """Timestamped (t, x, y) snapshots of the remote car, written by the network pump and read
+    by the render loop. Lock-free: a single writer publishes immutable tuples into a ring, so a
+    reader never sees a half-written snapshot even if the two run on different threads."""
+    SIZE = 32
+    INTERP_DELAY = 0.1        # render this far behind the newest snapshot to absorb jitter
+    MAX_EXTRAPOLATION = 0.15  # keep moving on packet loss for at most this long, then hold
+
+    def __init__(self):
+        self.slots = [None] * self.SIZE
+        self.count = 0            # total snapshots written; the newest is at count - 1
+        self.offset = None        # local clock minus remote clock (plus the fastest one-way delay seen)
+
+    def push(self, remote_t, x, y, local_now):
+        """Network thread: add a snapshot stamped with the sender's clock (seconds)."""
+        sample = local_now - remote_t
+        #track the fastest delivery; relax slowly so clock drift can't pin an old minimum
+        if self.offset is None or sample < self.offset:
+            self.offset = sample
+        else:
+            self.offset += 0.0005
+        self.slots[self.count % self.SIZE] = (remote_t, x, y)
+        self.count += 1
+
+    def sample(self, local_now):
+        """Render loop: interpolated (x, y) for the current frame, or None before any snapshot."""
+        count = self.count
+        offset = self.offset
+        if count == 0 or offset is None:
+            return None
+        target = local_now - offset - self.INTERP_DELAY
+        newest = self.slots[(count - 1) % self.SIZE]
+        if target >= newest[0]:
+            #past the newest snapshot: extrapolate briefly from the last two
+            if count < 2:
+                return newest[1], newest[2]
+            prev = self.slots[(count - 2) % self.SIZE]
+            span = newest[0] - prev[0]
+            if span <= 0:
+                return newest[1], newest[2]
+            ahead = min(target - newest[0], self.MAX_EXTRAPOLATION) / span
+            return (newest[1] + (newest[1] - prev[1]) * ahead,
+                    newest[2] + (newest[2] - prev[2]) * ahead)
+        #walk back to the pair of snapshots around the render time
+        later = newest
+        for back in range(2, min(count, self.SIZE) + 1):
+            earlier = self.slots[(count - back) % self.SIZE]
+            if earlier[0] <= target:
+                span = later[0] - earlier[0]
+                frac = (target - earlier[0]) / span if span > 0 else 1.0
+                return (earlier[1] + (later[1] - earlier[1]) * frac,
+                        earlier[2] + (later[2] - earlier[2]) * frac)
+            later = earlier
+        return later[1], later[2]  # older than anything buffered
+
+remote_snapshots = SnapshotBuffer()
+
+def ticks_in_flight(sent_at):
+    """Ticks the obstacles moved on since the peer took an obstacle update at synced time `sent_at`.
+    Rounded, not floored: both peers tick on the synced clock, so this is a whole number of
+    ticks plus jitter, and flooring would leave the obstacle a tick behind half of the time."""
+    if race_start_at is not None:
+        sent_at = max(sent_at, race_start_at)  # obstacles only move once the race is on
+    return max(round((peer_clock.now() - sent_at) * FPS), 0)
+
+def queue_obstacle_event(idx, x, y, img_index, gen=None):
+    """Send an obstacle update reliably, replacing any unacked update for the same obstacle.
+    Events without a gen are applied unconditionally (host-pushed sync without a shared seed);
+    with a gen they are collision respawns, the only ones the peer can't roll at the same time.
+    The synced timestamp lets the receiver move the obstacle on by the time spent in flight."""
+    text = f"E,{idx}:{x}:{y}:{img_index}"
+    sent_ms = int(peer_clock.now() * 1000)
+    if gen is not None:
+        text += f":{gen}"
+        collision_spawns_sent[idx] = (int(gen), sent_ms)
+    reliable_channel.send(f"{text},{sent_ms}", key=("E", idx))
+
+def apply_obstacle_event(text, game_map, sent_at=None):
+    """Apply one index:x:y:imgindex[:gen] obstacle event received from the peer, taken at synced time `sent_at`."""
+    evt_parts = text.split(":")
+    if len(evt_parts) < 4:
+        return
+    try:
+        evt_idx = int(evt_parts[0])
+        evt_x = int(evt_parts[1])
+        evt_y = int(evt_parts[2])
+        evt_img_idx = int(evt_parts[3])
+        evt_gen = int(evt_parts[4]) if len(evt_parts) >= 5 else None
+    except ValueError:
+        return  # skip malformed event
+    if not 0 <= evt_img_idx < len(game_map.obstacle_images):
+        evt_img_idx = 0
+    if sent_at is not None and race_start_at is not None:
+        #catch up on the frames spent in flight
+        evt_y += ticks_in_flight(sent_at) * 2 * OBSTACLE_SPEED
+    if evt_idx < len(obstacles):
+        if evt_gen is not None:
+            #an older respawn than ours is stale. the same gen is not the same spawn: the peer's
+            #collision respawn and our own off-screen recycle of that obstacle both make gen+1, at
+            #different times, and the collision is the one we didn't see, so it wins
+            if evt_gen < obstacles.gen[evt_idx]:
+                return
+            mine = collision_spawns_sent.get(evt_idx)
+            if evt_gen == obstacles.gen[evt_idx] and mine is not None and mine[0] == evt_gen:
+                #both cars hit it: both peers keep the earlier respawn (the host's on a tie),
+                #deciding on the same two timestamps so they can't swap views
+                theirs = round(sent_at * 1000) if sent_at is not None else None
+                if theirs is None or mine[1] < theirs or (mine[1] == theirs and network_role == "server"):
+                    return
+            obstacles.gen[evt_idx] = evt_gen
+        #update existing obstacle in place
+        obstacles.place(evt_idx, evt_x, evt_y)
+        obstacles.img_index[evt_idx] = evt_img_idx
+    else:
+        #append new obstacle if index equals current length (in case of new spawn)
+        obstacles.append(evt_x, evt_y, evt_img_idx)
+
+def handle_peer_message(message, game_map):
+    """Apply one reliable message from the peer."""
+    global remote_final_health, remote_final_view, race_start_at, netcode_mode, input_delay
+    kind, _, body = message.partition(",")
+    try:
+        if kind == "E":
+            evt_text, _, sent_at = body.partition(",")
+            apply_obstacle_event(evt_text, game_map, int(sent_at) / 1000.0 if sent_at else None)
+        elif kind == "F":
+            fields = body.split(",")
+            remote_final_health = int(fields[0])
+            if len(fields) >= 2:
+                remote_final_view = int(fields[1])
+        elif kind == "G":
+            fields = body.split(",")
+            race_start_at = int(fields[0]) / 1000.0
+            if len(fields) >= 2 and fields[1] in NETCODE_MODES.values():
+                netcode_mode = fields[1]
+            if len(fields) >= 3:
+                input_delay = int(fields[2])
+        elif kind == "H":
+            tick, _, crc = body.partition(",")
+            remote_hashes[int(tick)] = int(crc)
+    except ValueError:
+        pass  # skip malformed message
+
+TELEMETRY_PING_TICKS = 30    # ticks between rtt pings once the race runs
+TELEMETRY_DIR = "telemetry"  # per-match link telemetry (and frame timing) dumps
+
+class LinkTelemetry:
+    """Link quality of the p2p channel: rtt, loss, reordering, jitter and bandwidth.
+    Loss and reordering come from the D line's sequence numbers, jitter from the variation
+    of one-way transit times (RFC 3550 style), rtt from the clock sync pings. A sample is
+    taken every second for the hud and the match dump."""
+    def __init__(self):
+        self.send_seq = 0
+        self.highest_seq = -1
+        self.received = 0
+        self.reordered = 0
+        self.jitter = 0.0
+        self.last_transit = None
+        self.rtt = None
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.send_errors = 0
+        self.samples = []        # one dict per second for the match dump
+        self.current = None      # latest sample, shown by the hud
+        self.window = (time.monotonic(), 0, 0, 0, -1)  # counters at the start of this second
+
+    def next_seq(self):
+        self.send_seq += 1
+        return self.send_seq
+
+    def on_datagram(self, seq, sent_at, now):
+        self.received += 1
+        if seq <= self.highest_seq:
+            self.reordered += 1  # late (or duplicated) datagram
+        else:
+            self.highest_seq = seq
+        transit = now - sent_at
+        if self.last_transit is not None:
+            self.jitter += (abs(transit - self.last_transit) - self.jitter) / 16
+        self.last_transit = transit
+
+    def on_rtt(self, rtt):
+        self.rtt = rtt if self.rtt is None else 0.875 * self.rtt + 0.125 * rtt
+
+    def sample(self, now):
+        """Close the one-second window once it has elapsed."""
+        start, bytes_in, bytes_out, received, highest = self.window
+        elapsed = now - start
+        if elapsed < 1.0:
+            return
+        expected = self.highest_seq - highest
+        self.current = {
+            "t": round(peer_clock.now(), 3),
+            "rtt_ms": round(self.rtt * 1000, 1) if self.rtt is not None else None,
+            "loss": round(max(0.0, 1 - (self.received - received) / expected), 3) if expected > 0 else 0.0,
+            "reordered": self.reordered,
+            "jitter_ms": round(self.jitter * 1000, 1),
+            "in_bps": int((self.bytes_in - bytes_in) / elapsed),
+            "out_bps": int((self.bytes_out - bytes_out) / elapsed),
+        }
+        self.samples.append(self.current)
+        self.window = (now, self.bytes_in, self.bytes_out, self.received, self.highest_seq)
+
+    def summary(self):
+        expected = self.highest_seq + 1
+        return {
+            "datagrams_sent": self.send_seq,
+            "datagrams_received": self.received,
+            "loss": round(max(0.0, 1 - self.received / expected), 4) if expected > 0 else 0.0,
+            "reordered": self.reordered,
+            "jitter_ms": round(self.jitter * 1000, 2),
+            "rtt_ms": round(self.rtt * 1000, 2) if self.rtt is not None else None,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "send_errors": self.send_errors,
+        }
+
+    def dump(self, path, info):
+        """Write the summary and per-second samples of this match as json."""
         try:
-            #base state: send car x, y, health
-            data = f"{int(local_car.rect.x)},{int(local_car.rect.y)},{int(local_car.health)}"
-            if is_host and events_queue:
-                #include one obstacle event in the message (index:x:y:imgindex)
-                evt = events_queue.pop(0)
-                idx = evt["index"]; ox = evt["x"]; oy = evt["y"]; img_idx = evt["img_index"]
-                data += f",{idx}:{ox}:{oy}:{img_idx}"
-            else:
-                data += ",-1"
-            data += "\n"
-            peer_socket.send(data.encode())
-        except Exception as e:
-            #on send error, break out to end thread
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "w") as f:
+                json.dump({**info, "summary": self.summary(), "samples": self.samples}, f, indent=1)
+        except OSError as e:
+            print(f"Could not write telemetry ({path}): {e}")
+
+    def hud_lines(self):
+        s = self.current
+        if s is None:
+            return ["Net: measuring..."]
+        rtt = f"{s['rtt_ms']:.0f} ms" if s["rtt_ms"] is not None else "-"
+        return [f"RTT {rtt}  Loss {s['loss'] * 100:.1f}%",
+                f"Jitter {s['jitter_ms']:.1f} ms  Reord {s['reordered']}",
+                f"In {s['in_bps'] / 1000:.1f} kB/s  Out {s['out_bps'] / 1000:.1f} kB/s"]
+
+class NetworkPump:
+    """Non-blocking, selector-driven network processing for one match, run on the game thread.
+    poll() applies every datagram that has arrived and then sends this tick's outgoing lines, so
+    network state only changes at a known point in the frame and no thread has to wake up for it.
+    Datagrams are read (and stamped with their arrival time) earlier, by drain() every frame or
+    wait() while the loop idles: transit times, pongs and snapshots then measure the link, not
+    how long a datagram sat in the socket until the next tick."""
+    def __init__(self, peer_socket, local_car, remote_car, game_map, token=None, relay=None):
+        self.sock = peer_socket
+        self.sock.setblocking(False)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.sock, selectors.EVENT_READ)
+        self.local_car = local_car
+        self.remote_car = remote_car
+        self.game_map = game_map
+        self.scheduler = SendScheduler()
+        self.buffer = ""          # partial line (only the tcp fallback splits lines across reads)
+        self.inbox = deque()      # (line, local arrival time) read but not applied yet
+        #every datagram starts with the match token; anything else is from another match
+        self.prefix = f"T,{token}\n" if token else ""
+        self.relay = relay        # (ip, port) of the lobby's relay, used if the direct path fails
+        self.relayed = False
+        self.telemetry = LinkTelemetry()
+        self.ticks = 0
+        #latest full remote state assembled from keyframes and deltas
+        self.remote_x, self.remote_y = remote_car.rect.x, remote_car.rect.y
+        self.auth_fields = {}
+        self.closed = False
+
+    def poll(self, send=True):
+        """Process everything that has arrived, then (optionally) send this tick's datagram."""
+        if self.closed:
+            return
+        self.drain()
+        inbox = self.inbox
+        while inbox:
+            line, arrived = inbox.popleft()
+            try:
+                self.handle_line(line, arrived)
+            except ValueError:
+                pass  # skip malformed data
+        if send:
+            self.send_tick()
+        self.telemetry.sample(time.monotonic())
+
+    def drain(self):
+        """Read whatever is waiting on the socket into the inbox, without applying it."""
+        if not self.closed and self.selector.select(0):
+            self.receive()
+
+    def wait(self, seconds):
+        """Sleep up to `seconds`, reading datagrams the moment they arrive."""
+        deadline = time.monotonic() + seconds
+        while not self.closed:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            if self.selector.select(remaining):
+                self.receive()
+
+    def receive(self):
+        while True:
+            try:
+                chunk = self.sock.recv(MAX_DATAGRAM + 1024)
+            except (BlockingIOError, InterruptedError):
+                break  # drained
+            except ConnectionRefusedError:
+                continue  # icmp from a peer that isn't listening yet
+            except OSError as e:
+                print(f"Receive error: {e}")
+                self.closed = True
+                break
+            if not chunk:
+                self.closed = True  # connection closed by peer (tcp fallback)
+                break
+            arrived = peer_clock.local()
+            self.telemetry.bytes_in += len(chunk)
+            text = chunk.decode(errors="replace")
+            if self.prefix:
+                if not text.startswith(self.prefix):
+                    continue  # stray datagram from another match or an old session
+                text = text[len(self.prefix):]
+            self.buffer += text
+            #queue all complete lines in the buffer for the next poll
+            while "\n" in self.buffer:
+                line, self.buffer = self.buffer.split("\n", 1)
+                if line.strip():
+                    self.inbox.append((line, arrived))
+
+    def handle_line(self, line, arrived=None):
+        """Apply one line from the peer, dispatched on its tag. `arrived` is the local time
+        the datagram was read (now if not given)."""
+        global auth_state, lockstep_peer_ack
+        if arrived is None:
+            arrived = peer_clock.local()
+        parts = line.split(",")
+        if parts[0] == "S":
+            #update opponent state from whichever fields were sent; the render loop
+            #moves the car from the snapshot buffer, only health is applied directly
+            remote_t = None
+            for field in parts[1:]:
+                key, _, value = field.partition("=")
+                if key == "x":
+                    self.remote_x = int(value)
+                elif key == "y":
+                    self.remote_y = int(value)
+                elif key == "h":
+                    self.remote_car.health = int(value)
+                elif key == "t":
+                    remote_t = int(value) / 1000.0
+                elif key in ("a", "cx", "ch"):
+                    self.auth_fields[key] = int(value)
+            if remote_t is not None:
+                remote_snapshots.push(remote_t, self.remote_x, self.remote_y, peer_clock.synced(arrived))
+            if len(self.auth_fields) == 3 and network_role == "client":
+                #hand the host's view of our car to the game loop as one tuple
+                auth_state = (self.auth_fields["a"], self.auth_fields["cx"], self.auth_fields["ch"])
+        elif parts[0] == "I" and len(parts) >= 3:
+            #client inputs, newest first; keep the ones we haven't applied yet
+            newest = int(parts[1])
+            for back, steer in enumerate(parts[2:]):
+                seq = newest - back
+                if seq > applied_input_seq:
+                    remote_inputs[seq] = max(-1, min(1, int(steer)))
+        elif parts[0] == "L" and len(parts) >= 3:
+            #lockstep inputs, newest first; the ack lets us drop inputs the peer holds
+            newest = int(parts[1])
+            lockstep_peer_ack = max(lockstep_peer_ack, int(parts[2]))
+            for back, steer in enumerate(parts[3:]):
+                tick = newest - back
+                if tick > applied_input_seq:
+                    remote_inputs[tick] = max(-1, min(1, int(steer)))
+        elif parts[0] == "O" and len(parts) >= 2:
+            apply_obstacle_keyframe(parts, self.game_map)
+        elif parts[0] == "P" and len(parts) >= 2:
+            #answer clock sync pings with when the ping arrived and when the pong leaves, so the
+            #pinger can take the time it waited here for our next poll out of the rtt
+            received = int(peer_clock.synced(arrived) * 1000)
+            self.send_raw(f"Q,{parts[1]},{received},{int(peer_clock.now() * 1000)}\n")
+        elif parts[0] == "Q" and len(parts) >= 4:
+            t3 = arrived
+            t0, t1, t2 = int(parts[1]) / 1000.0, int(parts[2]) / 1000.0, int(parts[3]) / 1000.0
+            peer_clock.on_pong(t0, t1, t2, t3)
+            self.telemetry.on_rtt((t3 - t0) - (t2 - t1))
+        elif parts[0] == "D" and len(parts) >= 3:
+            self.telemetry.on_datagram(int(parts[1]), int(parts[2]) / 1000.0, peer_clock.synced(arrived))
+        elif parts[0] == "A":
+            #the reliable channel keeps wall-clock times
+            reliable_channel.on_ack([int(seq) for seq in parts[1:]], time.time() - (peer_clock.local() - arrived))
+        elif parts[0] == "R" and len(parts) >= 3:
+            if reliable_channel.on_reliable(int(parts[1])):
+                handle_peer_message(line.split(",", 2)[2], self.game_map)
+
+    def send_tick(self):
+        """Send the local car's changed state (or inputs) plus acks and due reliable messages."""
+        global obstacle_keyframe
+        self.scheduler.update_link_quality(reliable_channel)
+        local_car = self.local_car
+        fields = {"x": int(local_car.rect.x), "y": int(local_car.rect.y), "h": int(local_car.health)}
+        authoritative = netcode_mode == "authoritative" and race_start_at is not None
+        if netcode_mode == "lockstep" and race_start_at is not None:
+            #lockstep peers exchange nothing but inputs
+            state = lockstep_line()
+        elif authoritative and network_role == "client":
+            #the host simulates our car; all it needs from us are the inputs
+            state = input_line()
+        elif authoritative and auth_snapshot is not None:
+            #the ack and the client car's x must always travel together for reconciliation
+            fields["a"], fields["cx"], fields["ch"] = auth_snapshot
+            state = self.scheduler.next_state(fields, int(peer_clock.now() * 1000), always=("a", "cx"))
+        else:
+            state = self.scheduler.next_state(fields, int(peer_clock.now() * 1000))
+        data = state + "\n" if state else ""
+        #keep measuring rtt during the race
+        self.ticks += 1
+        if self.ticks % TELEMETRY_PING_TICKS == 0:
+            data += f"P,{int(peer_clock.local() * 1000)}\n"
+        keyframe = obstacle_keyframe
+        if keyframe and len(data) + len(keyframe) + 1 <= MAX_DATAGRAM // 2:
+            obstacle_keyframe = None
+            data += keyframe + "\n"
+        #pack acks and as many reliable messages as fit in one datagram
+        lines = reliable_channel.outgoing(MAX_DATAGRAM - len(self.prefix) - 32 - len(data), time.time())  # 32: D line
+        if lines:
+            data += "\n".join(lines) + "\n"
+        if data:
+            self.send_raw(data)
+
+    def use_relay(self):
+        """Send everything through the lobby's relay from now on (same socket, same token)."""
+        self.sock.connect(self.relay)
+        self.relayed = True
+
+    def send_raw(self, data):
+        seq = self.telemetry.next_seq()
+        payload = f"{self.prefix}D,{seq},{int(peer_clock.now() * 1000)}\n{data}".encode()
+        try:
+            self.telemetry.bytes_out += self.sock.send(payload)
+        except (BlockingIOError, InterruptedError, ConnectionRefusedError):
+            self.telemetry.send_errors += 1  # full buffer or peer not up yet: the datagram is simply lost
+        except OSError as e:
             print(f"Send error: {e}")
-            break
-        time.sleep(0.03)  # ~33 sends per second
-
-def p2p_receive_thread(peer_socket, remote_car, game_map):
-    """Continuously receive opponent car's state (and new obstacle events) from the peer."""
-    global running_network
-    buffer = ""  # buffer for assembling complete messages
-    while running_network:
+            self.telemetry.send_errors += 1
+            self.closed = True
+
+    def close(self):
         try:
-            chunk = peer_socket.recv(1024).decode()
-        except socket.timeout:
-            continue  # no data received, just loop again to check running_network
-        except Exception as e:
-            #connection closed or error
-            break
-        if not chunk:
-            break  # connection closed by peer
-        buffer += chunk
-        #process all complete lines in the buffer
-        while "\n" in buffer:
-            line, buffer = buffer.split("\n", 1)
-            if line.strip() == "":
-                continue
-            #parse the incoming line
-            parts = line.split(",")
-            if len(parts) < 3:
-                continue  # not a valid state message
+            self.selector.close()
+            self.sock.close()
+        except Exception:
+            pass
+
+LOBBY_UDP_PORT = 8006        # lobby server's udp port (endpoint registration and relay)
+PUNCH_TIME = 2.0             # seconds both peers spend punching; covers the skew between their match starts
+PUNCH_INTERVAL = 0.05
+
+def punch_hole(sock, token, candidates):
+    """Send punch datagrams to every candidate endpoint of the peer while it does the same to us,
+    so both nats open a mapping for the other side. Returns the address the peer was first heard
+    from (with a symmetric nat it may differ from all candidates), or None."""
+    punch = f"T,{token}\nN\n".encode()
+    sock.settimeout(PUNCH_INTERVAL)
+    found = None
+    deadline = time.monotonic() + PUNCH_TIME
+    while time.monotonic() < deadline:
+        for addr in ([found] if found else candidates):
             try:
-                opp_x = int(parts[0])
-                opp_y = int(parts[1])
-                opp_health = int(parts[2])
-            except ValueError:
-                continue  # skip malformed data
-            #update opponent car's position and health
-            remote_car.rect.x = opp_x
-            remote_car.rect.y = opp_y
-            remote_car.health = opp_health
-            #check for obstacle sync data
-            if len(parts) >= 4 and parts[3] != "-1":
-                #an obstacle event is included
-                evt_parts = parts[3].split(":")
-                if len(evt_parts) >= 4:
-                    try:
-                        evt_idx = int(evt_parts[0])
-                        evt_x = int(evt_parts[1])
-                        evt_y = int(evt_parts[2])
-                        evt_img_idx = int(evt_parts[3])
-                    except ValueError:
-                        evt_idx = None
-                    if evt_idx is not None:
-                        if evt_idx < len(obstacles):
-                            #update existing obstacle in place
-                            obstacles[evt_idx].rect.x = evt_x
-                            obstacles[evt_idx].rect.y = evt_y
-                            obstacles[evt_idx].image = game_map.obstacle_images[evt_img_idx].copy()
-                        else:
-                            #append new obstacle if index equals current length (in case of new spawn)
-                            if 0 <= evt_img_idx < len(game_map.obstacle_images):
-                                new_obs_img = game_map.obstacle_images[evt_img_idx]
-                            else:
-                                new_obs_img = game_map.obstacle_images[0]
-                            obstacles.append(Obstacle(new_obs_img, x=evt_x, y=evt_y))
-        #end while (processing lines)
-    #end while (running_network loop)
+                sock.sendto(punch, addr)
+            except OSError:
+                pass
+        try:
+            data, addr = sock.recvfrom(MAX_DATAGRAM + 1024)
+        except OSError:
+            continue  # timeout, or icmp from a candidate nobody listens on
+        if found is None and data.startswith(punch[:len(punch) - 2]):
+            found = addr
+            #keep punching a little longer so the peer hears us too
+            deadline = min(deadline, time.monotonic() + 10 * PUNCH_INTERVAL)
+    sock.settimeout(None)
+    return found
+
+
+def sync_race_start(pump, is_host, countdown):
+    """Estimate the peer clock offset by ping/pong, then agree on the race start instant.
+    The host schedules the start in synced time and sends it reliably; the client waits for it.
+    Returns the start instant in synced time."""
+    def ping():
+        pump.send_raw(f"P,{int(peer_clock.local() * 1000)}\n")
+        pump.poll()  # flush acks and reliable messages too
+        #wait on the socket so pongs are stamped as they arrive
+        pump.wait(0.05)
+        pump.poll(send=False)
+
+    deadline = time.monotonic() + CLOCK_SYNC_TIME
+    while time.monotonic() < deadline:
+        ping()
+    if peer_clock.rtt is None and pump.relay is not None:
+        #no pongs over the direct path (nat or firewall): both sides switch to the relay
+        print("No reply from peer, switching to the server relay")
+        pump.use_relay()
+        deadline = time.monotonic() + CLOCK_SYNC_TIME
+        while time.monotonic() < deadline:
+            ping()
+    if is_host:
+        #leave the client time to receive the start before its countdown begins
+        global input_delay
+        margin = 0.5 + (peer_clock.rtt or 0)
+        start_at = peer_clock.now() + countdown + margin
+        input_delay = lockstep_input_delay(peer_clock.rtt)
+        reliable_channel.send(f"G,{int(start_at * 1000)},{netcode_mode},{input_delay}", key="G")
+        return start_at
+    deadline = time.monotonic() + 3.0
+    while race_start_at is None and time.monotonic() < deadline:
+        ping()
+    if race_start_at is None:
+        print("No race start from host, starting on local clock")
+        return peer_clock.now() + countdown
+    return race_start_at
+
+#host-authoritative netcode state
+netcode_mode = "p2p"
+INPUT_REDUNDANCY = 8         # inputs repeated in every I line, so a lost datagram costs nothing
+input_history = deque()      # client: (seq, steer) inputs the host hasn't acknowledged yet
+remote_inputs = {}           # host: client inputs received but not applied yet, by seq
+applied_input_seq = 0        # host: last client input applied to the simulation
+auth_state = None            # client: (ack seq, car x, car health) from the host's latest snapshot
+auth_snapshot = None         # host: the same tuple as of the last tick, for the sender
+obstacle_keyframe = None     # host: pending O line for the sender
+
+def reconcile_local_car(car, history, state):
+    """Client prediction: rewind our car to the host's authoritative x for the last input
+    it applied, then replay the inputs it hasn't seen yet."""
+    ack, x, _ = state
+    while history and history[0][0] <= ack:
+        history.popleft()
+    car.rect.x = x
+    car.move(0)  # clamp to the road and recenter the hitbox
+    for _, steer in history:
+        car.move(STEER_SPEED * steer)
+
+def apply_remote_inputs(car):
+    """Host: apply the client's received inputs to its car in sequence order."""
+    global applied_input_seq
+    while True:
+        next_seq = applied_input_seq + 1
+        if next_seq in remote_inputs:
+            car.move(STEER_SPEED * remote_inputs.pop(next_seq))
+        elif remote_inputs and max(remote_inputs) > applied_input_seq + INPUT_REDUNDANCY:
+            pass  # lost even with redundancy: treat as no input and move on
+        else:
+            return
+        applied_input_seq = next_seq
+
+def input_line():
+    """Client: the I line carrying our most recent unacknowledged inputs, newest first."""
+    recent = list(input_history)[-INPUT_REDUNDANCY:]
+    if not recent:
+        return None
+    return f"I,{recent[-1][0]}," + ",".join(str(steer) for _, steer in reversed(recent))
+
+#lockstep netcode state (inputs reuse input_history / remote_inputs / applied_input_seq, keyed by tick)
+LOCKSTEP_WINDOW = 32         # most unacknowledged inputs carried in one L line, oldest first
+HASH_INTERVAL = 30           # ticks between state hashes
+LOCKSTEP_STALL_TIMEOUT = 5.0 # seconds without the peer's next input before the race is ended
+input_delay = 2              # ticks between sampling an input and simulating it
+lockstep_peer_ack = -1       # last tick the peer holds all of our inputs for
+remote_hashes = {}           # tick -> peer's state hash
+
+def lockstep_input_delay(rtt):
+    """Ticks of input delay that cover the one-way trip plus one send interval."""
+    if rtt is None:
+        return 3
+    return min(max(int(rtt / 2 * FPS) + 2, 2), 15)
+
+def lockstep_line():
+    """The L line: oldest unacknowledged inputs first (so a stalled peer always gets what it
+    waits for), written newest first, plus our own receive ack."""
+    while input_history and input_history[0][0] <= lockstep_peer_ack:
+        input_history.popleft()
+    pending = list(input_history)[:LOCKSTEP_WINDOW]
+    ack = applied_input_seq
+    while ack + 1 in remote_inputs:
+        ack += 1
+    if not pending:
+        return f"L,{ack},{ack}"
+    return f"L,{pending[-1][0]},{ack}," + ",".join(str(steer) for _, steer in reversed(pending))
+
+def lockstep_state_hash(tick, cars, obstacles):
+    """CRC of everything the lockstep simulation decides, in the same order on both peers."""
+    state = [tick]
+    for car in cars:
+        state += [car.rect.x, car.health]
+    n = obstacles.count
+    columns = (obstacles.x[:n], obstacles.y[:n], obstacles.img_index[:n], obstacles.gen[:n])
+    state += np.stack(columns, axis=1).ravel().tolist()  # x, y, img, gen per obstacle
+    return zlib.crc32(",".join(map(str, state)).encode())
+
+def step_lockstep_obstacles(obstacles, cars, game_map, seed):
+    """One deterministic obstacle step for lockstep: move, recycle, and collide against the cars
+    in a fixed order. Returns the cars that were hit."""
+    hit = []
+    obstacles.move(OBSTACLE_SPEED)
+    for idx in obstacles.below(SCREEN_HEIGHT):
+        respawn_obstacle(obstacles, idx, game_map, seed)
+    #a respawned obstacle is above the screen, so the next car can't hit it again
+    for car in cars:
+        for idx in obstacles.hits(car.hitbox):
+            car.health -= 1
+            hit.append(car)
+            respawn_obstacle(obstacles, idx, game_map, seed)
+    return hit
+
+def build_obstacle_keyframe(obstacles):
+    """Host: O line with every obstacle's authoritative position and generation."""
+    n = obstacles.count
+    rows = zip(obstacles.x[:n].tolist(), obstacles.y[:n].tolist(),
+               obstacles.img_index[:n].tolist(), obstacles.gen[:n].tolist())
+    fields = [f"{idx}:{x}:{y}:{img_idx}:{gen}" for idx, (x, y, img_idx, gen) in enumerate(rows)]
+    return f"O,{int(peer_clock.now() * 1000)}," + ",".join(fields)
+
+def apply_obstacle_keyframe(parts, game_map):
+    """Client: correct obstacles from the host's keyframe. Newer generations are adopted, the
+    same generation is moved to the host's position, older ones (we predicted ahead) are kept."""
+    frames = ticks_in_flight(int(parts[1]) / 1000.0)
+    for field in parts[2:]:
+        evt_parts = field.split(":")
+        if len(evt_parts) < 5:
+            continue
+        idx, x, y, img_idx, gen = (int(v) for v in evt_parts)
+        if idx >= len(obstacles) or not 0 <= img_idx < len(game_map.obstacle_images):
+            continue
+        if gen < obstacles.gen[idx]:
+            continue
+        if gen > obstacles.gen[idx]:
+            obstacles.gen[idx] = gen
+            obstacles.img_index[idx] = img_idx
+        obstacles.place(idx, x, y + frames * 2 * OBSTACLE_SPEED)
+
+def wait_until(synced_time, pump=None):
+    """Block until the synced clock reaches `synced_time`, keeping the window and the network alive."""
+    while True:
+        remaining = synced_time - peer_clock.now()
+        if remaining <= 0:
+            return
+        pygame.event.pump()
+        if pump:
+            pump.poll()
+            pump.wait(min(remaining, 0.02) + 0.001)
+        else:
+            pygame.time.delay(int(min(remaining, 0.02) * 1000) + 1)
 
 
 #handshake helper functions (legacy support)
@@ -493,14 +1542,461 @@ def establish_p2p_connection(connection_details):
     return peer_socket
 
 
+#simulation core (no rendering, sound or real time)
+
+def set_map_lanes(map_choice):
+    """Apply a map's lane limits to the road geometry used by cars and obstacles."""
+    global LANE_LEFT, LANE_RIGHT, LANE_WIDTH, ROAD_LEFT, ROAD_RIGHT
+    if map_choice in MAP_LANE_LIMITS:
+        LANE_LEFT, LANE_RIGHT = MAP_LANE_LIMITS[map_choice]
+        LANE_WIDTH = (LANE_RIGHT - LANE_LEFT) // 2
+        ROAD_LEFT = LANE_LEFT
+        ROAD_RIGHT = LANE_RIGHT - CAR_W
+
+class BlankMap:
+    """Stands in for GameMap in headless runs: blank obstacle images of the right size, no background."""
+    def __init__(self, map_id):
+        self.map_id = map_id
+        self.obstacle_images = tuple(pygame.Surface((OBST_W, OBST_H)) for _ in MAPS[map_id]["obstacles"])
+
+class Simulation:
+    """The race rules on their own: car movement, obstacle motion and recycling, collisions,
+    health and the tick clock, advanced one tick at a time by step(). run_game feeds it the
+    player's input and draws the result; bots, replays and benchmarks can step it headless.
+    role is None (single player), "server" or "client"; the netcode mode is set with set_mode()
+    once the peers have agreed on it. obstacle_count overrides the difficulty's obstacle count.
+    pixel_collisions checks hitbox overlaps against the sprite masks (needs a GameMap)."""
+    RACE_TIME = 30  # race duration in seconds
+
+    def __init__(self, map_choice, difficulty, seed, role=None, shared_timeline=True,
+                 game_map=None, car_paths=(None, None), two_cars=True, obstacle_count=None,
+                 pixel_collisions=False):
+        set_map_lanes(map_choice)
+        self.game_map = game_map or BlankMap(map_choice)
+        self.seed = seed
+        self.role = role
+        self.shared_timeline = shared_timeline
+        self.pixel_collisions = pixel_collisions
+        self.profiler = None  # FrameProfiler that step() reports its phases to
+        self.tick = 0
+        settings = DIFFICULTY_SETTINGS[difficulty]
+        #decide which lane is local vs. remote based on server/client role
+        local_lane, remote_lane = (0, 1) if role == "server" else (1, 0)
+        self.car1 = Car(local_lane, car_paths[0])
+        self.car2 = Car(remote_lane, car_paths[1]) if two_cars else None
+        self.car1.health = settings["health"]
+        if self.car2:
+            self.car2.health = settings["health"]
+        if obstacle_count is None:
+            obstacle_count = int(5 * settings["obstacle_multiplier"])
+        self.obstacles = self.spawn_obstacles(obstacle_count)
+        #cars in the same order on both peers (host's car first) so lockstep collisions resolve identically
+        self.lockstep_cars = (self.car1, self.car2) if role == "server" else (self.car2, self.car1)
+        self.set_mode("p2p")
+
+    def set_mode(self, mode):
+        """p2p, authoritative (the host simulates both cars, the client predicts its own) or lockstep."""
+        self.mode = mode
+        self.auth_host = mode == "authoritative" and self.role == "server"
+        self.auth_client = mode == "authoritative" and self.role == "client"
+        self.lockstep = mode == "lockstep"
+        #pixel tests are a local preference; lockstep peers must resolve every hit identically
+        masks = getattr(self.game_map, "obstacle_masks", None)
+        self.sprite_masks = masks if self.pixel_collisions and not self.lockstep else None
+
+    def spawn_obstacles(self, count):
+        """Initial obstacles, rolled from the match seed so both peers start alike."""
+        obstacles = ObstaclePool(count)
+        for i in range(count):
+            rng = obstacle_rng(self.seed, i, 0)
+            lane_choice = rng.choice([0, 1])
+            #choose a random obstacle image index (for consistency across players)
+            img_idx = rng.randrange(len(self.game_map.obstacle_images))
+            #place obstacle in its lane at a random horizontal position, and random spawn height above screen
+            lane_min, lane_max = lane_span(lane_choice)
+            x = rng.randint(lane_min, lane_max)
+            y = rng.randint(-SCREEN_HEIGHT, -50)
+            #simple check to avoid vertical overlap with the obstacles already in the same lane
+            retry = 0
+            while retry < 5 and not obstacles.slot_free(x, y):
+                y = rng.randint(-SCREEN_HEIGHT, -50)
+                retry += 1
+            obstacles.append(x, y, img_idx)
+        return obstacles
+
+    def step(self, inputs):
+        """Advance one tick. inputs["steer"] steers the local car (-1 left, 0 none, 1 right);
+        inputs["remote_steer"] the other car, in lockstep where both peers simulate it.
+        Returns events for the caller: ("crash", car) when an obstacle hit a car and
+        ("spawn", idx) when an obstacle respawned in a way the peer has to be told about."""
+        events = []
+        car1, car2 = self.car1, self.car2
+        car1.move(STEER_SPEED * inputs.get("steer", 0))
+        if self.lockstep:
+            car2.move(STEER_SPEED * inputs.get("remote_steer", 0))
+            for car in step_lockstep_obstacles(self.obstacles, self.lockstep_cars, self.game_map, self.seed):
+                events.append(("crash", car))
+            if self.profiler:
+                self.profiler.lap("obstacles")
+            self.tick += 1
+            return events
+        single = car2 is None
+        is_host = self.role == "server"
+        obstacles = self.obstacles
+        obstacles.move(OBSTACLE_SPEED)  # move every obstacle down
+        #in client mode without a shared seed, skip local respawn – wait for host sync
+        #(obstacles left below the screen can't hit anything meanwhile)
+        if single or is_host or self.shared_timeline:
+            #recycle obstacles gone off the screen bottom to the top with a new position
+            for idx in obstacles.below(SCREEN_HEIGHT):
+                respawn_obstacle(obstacles, idx, self.game_map, self.seed)
+                #if host without a shared seed, the client has to hear about it
+                if is_host and not self.shared_timeline:
+                    events.append(("spawn", idx))
+        if self.profiler:
+            self.profiler.lap("obstacles")
+        #collision detection for player car (car1)
+        for idx in obstacles.hits(car1.hitbox, self.sprite_masks, car1.mask):
+            if not self.auth_client:
+                car1.health -= 1  # in authoritative mode the host decides our health
+            events.append(("crash", car1))
+            #remove or reset the obstacle that was hit
+            if single:
+                respawn_obstacle(obstacles, idx, self.game_map, self.seed)
+            elif self.shared_timeline:
+                #either peer: collisions are the only divergence from the seeded timeline
+                respawn_obstacle(obstacles, idx, self.game_map, self.seed)
+                #an authoritative client only predicts the respawn; it is the same spawn the host rolls
+                if not self.auth_client:
+                    events.append(("spawn", idx))
+            elif is_host:
+                #host: reposition obstacle (like spawning a new one) and sync to client
+                respawn_obstacle(obstacles, idx, self.game_map, self.seed)
+                events.append(("spawn", idx))
+            else:
+                #client: push obstacle out of view (host will handle actual reset)
+                obstacles.place(idx, obstacles.x[idx], SCREEN_HEIGHT + 100)
+        #collisions for the opponent's car are handled by that player's instance,
+        #except for the authoritative host, which simulates it
+        if self.auth_host:
+            for idx in obstacles.hits(car2.hitbox, self.sprite_masks, car2.mask):
+                car2.health -= 1
+                events.append(("crash", car2))
+                respawn_obstacle(obstacles, idx, self.game_map, self.seed)
+                events.append(("spawn", idx))
+        if self.profiler:
+            self.profiler.lap("collisions")
+        self.tick += 1
+        return events
+
+    def race_over(self, race_clock):
+        return self.car1.health <= 0 or (self.car2 is not None and self.car2.health <= 0) or race_clock >= self.RACE_TIME
+
+def render_positions(sim):
+    """Positions of everything drawn, taken before each tick so frames can interpolate from them."""
+    car2 = sim.car2
+    return ((sim.car1.rect.x, sim.car1.rect.y),
+            (car2.rect.x, car2.rect.y) if car2 else None,
+            sim.obstacles.positions())
+
+def lerp(a, b, alpha):
+    return a + (b - a) * alpha
+
+
+#frame profiling
+
+PROFILE_FRAMES = 600  # frames behind the overlay's rolling percentiles (5 s at 120 fps)
+
+class FrameProfiler:
+    """Wall time of each phase of a frame, to tell what a stutter is made of. lap(phase)
+    charges the time since the previous lap to `phase` (a frame running several ticks adds
+    them up); end_frame() closes the frame into a ring buffer that the overlay takes rolling
+    p50/p99 from. With keep_all every frame is also kept for the end-of-match dump."""
+    PHASES = ("input", "obstacles", "collisions", "network", "draw", "flip", "idle")
+
+    def __init__(self, keep_all=False):
+        self.recent = deque(maxlen=PROFILE_FRAMES)
+        self.frames = [] if keep_all else None
+        self.slot = {phase: i for i, phase in enumerate(self.PHASES)}
+        self.current = [0.0] * len(self.PHASES)
+        self.last = time.perf_counter()
+        self.lines = ["Frame: measuring..."]
+        self.next_refresh = 0.0
+
+    def lap(self, phase):
+        now = time.perf_counter()
+        self.current[self.slot[phase]] += (now - self.last) * 1000
+        self.last = now
+
+    def end_frame(self):
+        self.recent.append(self.current)
+        if self.frames is not None:
+            self.frames.append(self.current)
+        self.current = [0.0] * len(self.PHASES)
+
+    def percentiles(self, frames):
+        """{phase: (p50, p99)} in ms over `frames`, plus the whole frame."""
+        times = np.array(frames)
+        times = np.column_stack((times, times.sum(axis=1)))
+        p50, p99 = np.percentile(times, [50, 99], axis=0)
+        names = self.PHASES + ("frame",)
+        return {name: (round(float(p50[i]), 3), round(float(p99[i]), 3)) for i, name in enumerate(names)}
+
+    def hud_lines(self):
+        """Overlay text, recomputed twice a second."""
+        now = time.perf_counter()
+        if self.recent and now >= self.next_refresh:
+            self.next_refresh = now + 0.5
+            stats = self.percentiles(self.recent)
+            self.lines = [f"{name}: {p50:.2f} / {p99:.2f} ms" for name, (p50, p99) in stats.items()]
+        return self.lines
+
+    def dump(self, path, info):
+        """Write every frame's phase timings (ms) and their percentiles as json."""
+        if not self.frames:
+            return
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "w") as f:
+                json.dump({**info, "phases": list(self.PHASES), "percentiles": self.percentiles(self.frames),
+                           "frames": [[round(ms, 3) for ms in frame] for frame in self.frames]}, f)
+        except OSError as e:
+            print(f"Could not write frame timings ({path}): {e}")
+
+
 #game loop (offline & online modes)
 
+def keyboard_steer():
+    """Steering from the arrow keys held down: -1 left, 1 right, 0 neither."""
+    keys = pygame.key.get_pressed()
+    if keys[pygame.K_LEFT]:
+        return -1
+    elif keys[pygame.K_RIGHT]:
+        return 1
+    return 0
+
+class RaceLoop:
+    """The race itself, shared by run_game and FrameBenchmark: advance() runs the fixed ticks that
+    are due and frame() draws the race interpolated between the last two. The caller supplies the
+    steering and the pacing (the keyboard and the clock in the game, scripted drivers and back to
+    back frames in the benchmark). Phases are timed on sim.profiler."""
+    def __init__(self, screen, sim, bg, pump=None, start_time=0.0, crash_sound=None,
+                 show_net_hud=False, show_profiler=False, tick_clock=False):
+        global applied_input_seq
+        self.screen = screen
+        self.sim = sim
+        self.bg = bg
+        self.pump = pump
+        self.start_time = start_time
+        self.crash_sound = crash_sound
+        #link telemetry overlay under health/time (F3) and per-phase frame timings (F4)
+        self.show_net_hud = show_net_hud
+        self.show_profiler = show_profiler
+        #lockstep races run on simulation ticks so both peers end on the same tick
+        self.tick_clock = tick_clock or sim.lockstep
+        self.explosion_image = asset_cache.image(EXPLOSION_IMAGE_PATH, EXPLOSION_SIZE)
+        self.explosion_effects = []
+        font = pygame.font.SysFont("Arial", 24)
+        small_font = pygame.font.SysFont("Arial", 16)
+        #hud text surfaces are only re-rendered when their value changes
+        self.health_label = CachedText(font)
+        self.time_label = CachedText(font)
+        self.net_labels = [CachedText(small_font) for _ in range(3)]  # one per telemetry hud line
+        self.profiler_labels = [CachedText(small_font) for _ in range(len(FrameProfiler.PHASES) + 1)]
+        self.running = True
+        self.accumulator = 0.0
+        self.prev_positions = render_positions(sim)
+        self.ticks_run = 0            # every pass of the tick loop, stalled lockstep ticks included
+        self.last_frame = None        # what the last presented frame showed
+        self.input_seq = 0
+        self.last_auth_state = None
+        self.lockstep_local = {}      # tick -> our input scheduled for that tick
+        self.local_hashes = {}        # tick -> our state hash
+        self.desync_reported = False
+        self.last_advance = time.perf_counter()  # lockstep: when the peer's input last let us step
+        if sim.lockstep:
+            #the first input_delay ticks have no input on either side
+            applied_input_seq = -1
+            for tick in range(input_delay):
+                self.lockstep_local[tick] = 0
+                remote_inputs[tick] = 0
+
+    def race_clock(self):
+        return self.sim.tick / FPS if self.tick_clock else peer_clock.now() - self.start_time
+
+    def advance(self, elapsed, read_steer):
+        """Run the ticks due `elapsed` seconds after the last call, each steered by read_steer().
+        Returns how far the frame to draw now is from the last tick towards the next one."""
+        tick_dt = 1.0 / FPS
+        #after a long stall (window drag, breakpoint) catch up at most MAX_FRAME_TIME
+        self.accumulator += min(elapsed, MAX_FRAME_TIME)
+        while self.running and self.accumulator >= tick_dt:
+            self.accumulator -= tick_dt
+            self.tick(read_steer())
+        return self.accumulator / tick_dt
+
+    def tick(self, steer):
+        """One fixed tick: netcode, simulation, effects and one network pass."""
+        global applied_input_seq, auth_snapshot, obstacle_keyframe
+        sim, pump, profiler = self.sim, self.pump, self.sim.profiler
+        car1, car2, obstacles = sim.car1, sim.car2, sim.obstacles
+        self.ticks_run += 1
+        self.prev_positions = render_positions(sim)
+        events = []
+        if sim.lockstep:
+            #advance only once the peer's input for this tick has arrived (otherwise stall)
+            tick = sim.tick
+            if tick in remote_inputs:
+                remote_steer = remote_inputs.pop(tick)
+                local_steer = self.lockstep_local.pop(tick)
+                applied_input_seq = tick
+                #this frame's input goes out now and is simulated input_delay ticks later
+                self.lockstep_local[tick + input_delay] = steer
+                input_history.append((tick + input_delay, steer))
+                profiler.lap("input")
+                events = sim.step({"steer": local_steer, "remote_steer": remote_steer})
+                self.last_advance = time.perf_counter()
+                if sim.tick % HASH_INTERVAL == 0:
+                    self.local_hashes[sim.tick] = lockstep_state_hash(sim.tick, sim.lockstep_cars, obstacles)
+                    reliable_channel.send(f"H,{sim.tick},{self.local_hashes[sim.tick]}")
+            #compare state hashes once both sides have one for the same tick
+            for tick in [t for t in list(remote_hashes) if t in self.local_hashes]:
+                if remote_hashes.pop(tick) != self.local_hashes.pop(tick) and not self.desync_reported:
+                    print(f"Lockstep desync detected at tick {tick}")
+                    self.desync_reported = True
+        else:
+            if sim.auth_client:
+                #rewind to the host's last word on our car and replay what it hasn't seen yet
+                state = auth_state
+                if state is not None and state is not self.last_auth_state:
+                    self.last_auth_state = state
+                    reconcile_local_car(car1, input_history, state)
+                    car1.health = state[2]
+                #then predict this tick's input locally and send it to the host
+                self.input_seq += 1
+                input_history.append((self.input_seq, steer))
+            if sim.auth_host:
+                #the host simulates the client's car from its inputs
+                apply_remote_inputs(car2)
+
+            #place the opponent's car from the jitter buffer (interpolated a little behind real time)
+            if car2 and not sim.auth_host:
+                remote_pos = remote_snapshots.sample(peer_clock.now())
+                if remote_pos:
+                    car2.rect.x = round(remote_pos[0])
+                    car2.rect.y = round(remote_pos[1])
+                    car2.hitbox.center = car2.rect.center
+
+            #move the car, move/recycle obstacles and resolve collisions
+            profiler.lap("input")
+            events = sim.step({"steer": steer})
+        #explosions last a fixed number of ticks
+        for effect in self.explosion_effects:
+            effect["timer"] -= 1
+        self.explosion_effects = [eff for eff in self.explosion_effects if eff["timer"] > 0]
+        for kind, subject in events:
+            if kind == "crash" and subject is car1:
+                if self.crash_sound:
+                    self.crash_sound.play()
+                #add an explosion effect centered on the player's car
+                explosion_x = car1.rect.centerx - self.explosion_image.get_width() // 2
+                explosion_y = car1.rect.centery - self.explosion_image.get_height() // 2
+                self.explosion_effects.append({"x": explosion_x, "y": explosion_y, "timer": 10})
+            elif kind == "spawn" and running_network:
+                #tell the peer about respawns it can't roll itself
+                queue_obstacle_event(subject, obstacles.x[subject], obstacles.y[subject],
+                                     obstacles.img_index[subject],
+                                     obstacles.gen[subject] if sim.shared_timeline else None)
+        self.bg.scroll(speed=5)
+        if sim.auth_host:
+            #publish this tick's authoritative view of the client's car for the sender
+            auth_snapshot = (applied_input_seq, car2.rect.x, car2.health)
+            if sim.tick % SendScheduler.KEYFRAME_TICKS == 0:
+                obstacle_keyframe = build_obstacle_keyframe(obstacles)
+        #one network pass per tick: apply what arrived, send this tick's state
+        if pump:
+            pump.poll()
+        profiler.lap("network")
+        #check for race end conditions
+        if sim.race_over(self.race_clock()):
+            self.running = False
+        elif sim.lockstep and time.perf_counter() - self.last_advance > LOCKSTEP_STALL_TIMEOUT:
+            #the peer left or lost the link, so the race clock can't reach the end: finish on
+            #the last tick both sides simulated, as the other netcodes finish on the last
+            #health heard from a peer that went quiet
+            print(f"No input from peer for {LOCKSTEP_STALL_TIMEOUT:.0f} s, ending the race")
+            self.running = False
+
+    def frame(self, alpha):
+        """Draw background, cars and obstacles alpha of the way from the previous tick to the last
+        one, plus the hud, and present it. Returns False for a frame skipped as unchanged."""
+        sim, profiler, screen, bg = self.sim, self.sim.profiler, self.screen, self.bg
+        car1, car2 = sim.car1, sim.car2
+        (car1_prev, car2_prev, obstacles_prev) = self.prev_positions
+        car1_pos = (lerp(car1_prev[0], car1.rect.x, alpha), lerp(car1_prev[1], car1.rect.y, alpha))
+        remote_pos = None
+        if car2:
+            if not sim.auth_host and not sim.lockstep:
+                #p2p / authoritative client: the snapshot buffer interpolates in continuous time
+                remote_pos = remote_snapshots.sample(peer_clock.now())
+            if remote_pos is None:
+                remote_pos = (lerp(car2_prev[0], car2.rect.x, alpha), lerp(car2_prev[1], car2.rect.y, alpha))
+        time_left = max(0, int(Simulation.RACE_TIME - self.race_clock()))
+        net_lines = tuple(self.pump.telemetry.hud_lines()) if self.show_net_hud and self.pump else ()
+        profiler_lines = tuple(profiler.hud_lines()) if self.show_profiler else ()
+        #the scroll moves every pixel on screen, so there are no partial updates to make during
+        #the race; but frames faster than the scroll moves come out pixel for pixel the same as
+        #the last one, and those are skipped altogether. obstacles and explosions only change on
+        #ticks, and obstacles move in step with the scroll.
+        frame = (self.ticks_run, bg.position(alpha * 2 * 5),
+                 tuple(int(v) for v in car1_pos), remote_pos and tuple(int(v) for v in remote_pos),
+                 car1.health, time_left, net_lines, profiler_lines)
+        if frame == self.last_frame:
+            profiler.lap("draw")
+            return False
+        self.last_frame = frame
+        bg.draw(screen, offset=alpha * 2 * 5)
+        #draw road boundary lines (for visual reference)
+        pygame.draw.rect(screen, (200, 200, 200), (ROAD_LEFT - 4, 0, 4, SCREEN_HEIGHT))
+        pygame.draw.rect(screen, (200, 200, 200), (ROAD_RIGHT + CAR_W, 0, 4, SCREEN_HEIGHT))
+        car1.draw(screen, car1_pos)
+        if car2:
+            car2.draw(screen, remote_pos)
+        sim.obstacles.draw(screen, sim.game_map.obstacle_images, obstacles_prev, alpha)
+        #draw explosion effects on top
+        for effect in self.explosion_effects:
+            screen.blit(self.explosion_image, (effect["x"], effect["y"]))
+        #hud: health & timer
+        screen.blit(self.health_label.render(f"Health: {car1.health}"), (10, 10))
+        screen.blit(self.time_label.render(f"Time: {time_left}"), (10, 40))
+        for row, line in enumerate(net_lines):
+            screen.blit(self.net_labels[row].render(line), (10, 72 + 18 * row))
+        #frame timings (p50 / p99 per phase) top right
+        for row, line in enumerate(profiler_lines):
+            screen.blit(self.profiler_labels[row].render(line), (SCREEN_WIDTH - 200, 10 + 18 * row))
+        profiler.lap("draw")
+        pygame.display.flip()
+        profiler.lap("flip")
+        return True
+
 def run_game(options):
     """Launch the racing game loop with given options (map, difficulty, car choices, networking info)."""
-    global LANE_LEFT, LANE_RIGHT, LANE_WIDTH, ROAD_LEFT, ROAD_RIGHT
-    global running_network, network_role, events_queue, obstacles
+    global running_network, network_role, obstacles, reliable_channel, remote_snapshots, remote_final_health
+    global peer_clock, race_start_at, remote_final_view, netcode_mode
+    global applied_input_seq, auth_state, auth_snapshot, obstacle_keyframe, lockstep_peer_ack
     pygame.init()
-    screen = pygame.display.set_mode((SCREEN_WIDTH, SCREEN_HEIGHT))
+    vsync = bool(options.get("vsync"))
+    screen = None
+    if vsync:
+        try:
+            #vsync needs a hardware-accelerated (scaled) display, so SCALED is only asked for
+            #with vsync: it also lets sdl integer-scale the window on high-dpi or large screens.
+            #fall back to the plain window if the driver refuses
+            screen = pygame.display.set_mode((SCREEN_WIDTH, SCREEN_HEIGHT), pygame.SCALED, vsync=1)
+        except (pygame.error, TypeError):
+            vsync = False
+    if screen is None:
+        screen = pygame.display.set_mode((SCREEN_WIDTH, SCREEN_HEIGHT))
     if options.get("single_player"):
         pygame.display.set_caption("EECE 350 Racing Game (Single Player)")
     else:
@@ -509,50 +2005,27 @@ def run_game(options):
 
     #load audio and explosion image
     try:
-        pygame.mixer.music.load("resources/Sound Effects/Game Music.mp3")
-        collision_sound = pygame.mixer.Sound("resources/Sound Effects/Crash Sound.mp3")
-        countdown_sound = pygame.mixer.Sound("resources/Sound Effects/Countdown.mp3")
-        explosion_image = pygame.image.load("resources/Obstacles/BOOM.png").convert_alpha()
-        explosion_image = pygame.transform.scale(explosion_image, (50, 50))
+        pygame.mixer.music.load(GAME_MUSIC_PATH)  # streamed, so not cached
+        collision_sound = asset_cache.sound(CRASH_SOUND_PATH)
+        countdown_sound = asset_cache.sound(COUNTDOWN_SOUND_PATH)
+        asset_cache.image(EXPLOSION_IMAGE_PATH, EXPLOSION_SIZE)  # drawn by the race loop
     except Exception as e:
         print(f"Error loading game assets: {e}")
         return  # Cannot proceed without assets
 
-    explosion_effects = []
     clock = pygame.time.Clock()
-    font = pygame.font.SysFont("Arial", 24)
 
     #game settings
     map_choice = options["map_choice"]
-    difficulty = options["difficulty"]
-    settings = DIFFICULTY_SETTINGS[difficulty]
-    starting_health = settings["health"]
-    obstacle_multiplier = settings["obstacle_multiplier"]
     car_color_choice = options["car_color"]
 
-    #apply map-specific lane limits
-    if map_choice in MAP_LANE_LIMITS:
-        LANE_LEFT, LANE_RIGHT = MAP_LANE_LIMITS[map_choice]
-        LANE_WIDTH = (LANE_RIGHT - LANE_LEFT) // 2
-        ROAD_LEFT = LANE_LEFT
-        ROAD_RIGHT = LANE_RIGHT - CAR_W
-        #decide which lane is local vs. remote based on server/client role ───
-    if options.get("role") == "server":
-        local_lane, remote_lane = 0, 1
-    else:
-        local_lane, remote_lane = 1, 0
-
-
-    #initialize player car (car1) and opponent car (car2)
+    #map and car sprites; the simulation owns the game state and run_game only draws it
     game_map = GameMap(map_choice)
     bg = ScrollingBG(game_map.background)
     #pick the first available car path if user's choice isn't found
     default_car_path = next(iter(CAR_OPTIONS.values()))
-    car1 = Car(lane=local_lane,car_image_path=CAR_OPTIONS.get(car_color_choice, default_car_path))
-
-    if options.get("single_player"):
-        car2 = None
-    else:
+    car_paths = [CAR_OPTIONS.get(car_color_choice, default_car_path), None]
+    if not options.get("single_player"):
         opp_car_choice = options.get("opponent_car")
         if opp_car_choice not in CAR_OPTIONS:
             #pick any color different from the local player's, or just the first one
@@ -561,73 +2034,76 @@ def run_game(options):
             if car_color_choice in keys and len(keys) > 1:
                 keys.remove(car_color_choice)
             opp_car_choice = keys[0]
-        car2 = Car(lane=remote_lane,car_image_path=CAR_OPTIONS[opp_car_choice])
-
-    #set starting health for cars
-    car1.health = starting_health
-    if car2:
-        car2.health = starting_health
-
-    #create obstacles based on difficulty
-    obstacles = []
-    base_count = 5
-    total_obstacles = int(base_count * obstacle_multiplier)
-    #avoid overlapping obstacles as much as possible by re-rolling positions if needed
-    for i in range(total_obstacles):
-        lane_choice = random.choice([0, 1])
-        #choose a random obstacle image index (for consistency across players)
-        img_idx = random.randrange(len(game_map.obstacle_images))
-        obs_img = game_map.obstacle_images[img_idx]
-        new_obs = Obstacle(obs_img, lane=lane_choice)
-        #simple check to avoid vertical overlap in same lane
-        retry = 0
-        while retry < 5:
-            overlap = False
-            for obs in obstacles:
-                if obs.rect.y - new_obs.rect.y < OBST_H and obs.rect.y - new_obs.rect.y > -OBST_H and obs.rect.x != new_obs.rect.x:
-                    if lane_choice == getattr(obs, "lane", lane_choice):
-                        overlap = True
-                        break
-            if overlap:
-                new_obs.rect.y = random.randint(-SCREEN_HEIGHT, -50)
-                retry += 1
-            else:
-                break
-        new_obs.lane = lane_choice
-        obstacles.append(new_obs)
+        car_paths[1] = CAR_OPTIONS[opp_car_choice]
+
+    #a seed from match_start means both peers roll the same obstacle timeline;
+    #otherwise (single player / older server) pick a local one
+    shared_timeline = not options.get("single_player") and options.get("seed") is not None
+    match_seed = options["seed"] if shared_timeline else random.getrandbits(32)
+
+    #initialize player car (car1), opponent car (car2) and obstacles based on difficulty
+    sim = Simulation(map_choice, options["difficulty"], match_seed,
+                     role=options.get("role") if not options.get("single_player") else None,
+                     shared_timeline=shared_timeline, game_map=game_map, car_paths=car_paths,
+                     two_cars=not options.get("single_player"),
+                     pixel_collisions=bool(options.get("pixel_collisions")))
+    car1, car2, obstacles = sim.car1, sim.car2, sim.obstacles
     #prepare networking (if multiplayer)
     peer_socket = None
-    send_thread = recv_thread = None
+    pump = None
     running_network = False
     network_role = options.get("role") if not options.get("single_player") else None
-    events_queue = []  # reset events queue for this game
+    #fresh reliable channel for this game
+    reliable_channel = ReliableChannel()
+    remote_snapshots = SnapshotBuffer()
+    remote_final_health = None
+    race_start_at = None
+    remote_final_view = None
+    collision_spawns_sent.clear()
+    #the host picks the netcode mode and tells the client with the race start
+    netcode_mode = options.get("netcode", "p2p") if network_role == "server" else "p2p"
+    if netcode_mode == "lockstep" and not shared_timeline:
+        netcode_mode = "p2p"  # lockstep needs both peers to roll the same obstacles
+    lockstep_peer_ack = -1
+    remote_hashes.clear()
+    input_history.clear()
+    remote_inputs.clear()
+    applied_input_seq = 0
+    auth_state = auth_snapshot = obstacle_keyframe = None
+    #the host's clock is the reference for the race window
+    peer_clock = PeerClock(is_reference=(network_role != "client"))
     if options.get("role") in ["server", "client"] and "opponent_ip" in options:
         #establish peer-to-peer connection using udp for real-time sync
         try:
             opponent_ip = options["opponent_ip"]
             opponent_port = options.get("opponent_port", 12345)
-            if options["role"] == "server":
-                #as server (host), bind a udp socket on port+1 and send to opponent's port
+            if options.get("p2p_socket") is not None:
+                #bound to an os-chosen port when the challenge was sent or accepted;
+                #the server told each side the other's port and, if it registered, its nat-mapped endpoint
+                peer_socket = options["p2p_socket"]
+                candidates = [(opponent_ip, opponent_port)]
+                if options.get("opponent_public") and options["opponent_public"] not in candidates:
+                    candidates.append(options["opponent_public"])
+                found = punch_hole(peer_socket, options.get("match_token", ""), candidates)
+                if found is None:
+                    print("Hole punching failed, the relay will be used if the peer stays silent")
+                peer_socket.connect(found or candidates[-1])
+            elif options["role"] == "server":
+                #older server with fixed ports: as host, bind a udp socket on port+1 and send to opponent's port
                 server_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-                server_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
                 server_sock.bind(("", opponent_port + 1))
                 server_sock.connect((opponent_ip, opponent_port))
-                server_sock.settimeout(0.1)
                 peer_socket = server_sock
             else:
                 #as client, bind udp socket on opponent_port and send to server's port+1
                 client_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-                client_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
                 client_sock.bind(("", opponent_port))
                 client_sock.connect((opponent_ip, opponent_port + 1))
-                client_sock.settimeout(0.1)
                 peer_socket = client_sock
-            #start network threads for real-time sync
+            #the game loop pumps the socket once per tick for real-time sync
             running_network = True
-            send_thread = threading.Thread(target=p2p_send_thread, args=(peer_socket, car1), daemon=True)
-            recv_thread = threading.Thread(target=p2p_receive_thread, args=(peer_socket, car2, game_map), daemon=True)
-            send_thread.start()
-            recv_thread.start()
+            pump = NetworkPump(peer_socket, car1, car2, game_map, token=options.get("match_token"),
+                               relay=options.get("relay"))
         except Exception as e:
             print(f"P2P connection error: {e}")
             running_network = False
@@ -640,162 +2116,92 @@ def run_game(options):
                 peer_socket = establish_p2p_connection(conn_details)
                 if peer_socket:
                     #use tcp socket from fallback
-                    peer_socket.settimeout(0.1)
                     running_network = True
-                    send_thread = threading.Thread(target=p2p_send_thread, args=(peer_socket, car1), daemon=True)
-                    recv_thread = threading.Thread(target=p2p_receive_thread, args=(peer_socket, car2, game_map), daemon=True)
-                    send_thread.start()
-                    recv_thread.start()
+                    pump = NetworkPump(peer_socket, car1, car2, game_map)
             except Exception as e:
                 print(f"P2P connection error: {e}")
                 running_network = False
 
-    #if this side is host, prepare to send initial obstacle positions to client
-    if network_role == "server":
-        #populate events_queue with initial obstacle info (index, x, y, image index) for sync
-        for idx, obs in enumerate(obstacles):
-            #find which obstacle image index corresponds (by matching surface in list)
-            img_index = 0
-            for j, img in enumerate(game_map.obstacle_images):
-                #compare by size/filename assumption or fallback to first if not found
-                if img.get_size() == obs.image.get_size():
-                    img_index = j
-                    break
-            events_queue.append({"index": idx, "x": obs.rect.x, "y": obs.rect.y, "img_index": img_index})
+    #if this side is host without a shared seed, send initial obstacle positions to client
+    if network_role == "server" and not shared_timeline:
+        #queue initial obstacle info (index, x, y, image index) for sync
+        for idx in range(len(obstacles)):
+            queue_obstacle_event(idx, obstacles.x[idx], obstacles.y[idx], obstacles.img_index[idx])
 
         #draw a single frame and pause 50 ms
-    bg.draw(screen, speed=0)
+    bg.draw(screen)
     car1.draw(screen)
     if car2:
         car2.draw(screen)
-    for obs in obstacles:
-        if obs.rect.y < SCREEN_HEIGHT:
-            obs.draw(screen)
+    obstacles.draw(screen, game_map.obstacle_images)
     pygame.display.flip()
     pygame.time.delay(50)   # 0.05 s pause
 
+    #agree on a shared start instant so both sides run the same race window
+    countdown = 4.0                   # length of the countdown audio
+    if running_network:
+        race_start_at = sync_race_start(pump, network_role == "server", countdown)
+    else:
+        race_start_at = peer_clock.now() + countdown
     #countdown before the race starts
+    wait_until(race_start_at - countdown, pump)
     countdown_sound.play()
-    pygame.time.delay(4000)           # wait for 4 s countdown audio
+    wait_until(race_start_at, pump)        # wait for 4 s countdown audio
     pygame.mixer.music.play(-1)      # now start background music
-    start_time = time.time()         # kick off the race timer
-    total_time = 30  # race duration in seconds
-    running = True
-
-    #main game loop
-    while running:
+    #the netcode mode is settled once the race start has been agreed
+    sim.set_mode(netcode_mode if running_network else "p2p")
+    #host-authoritative netcode: the host simulates both cars, the client predicts its own;
+    #lockstep netcode: both peers run the same simulation from both players' inputs
+    auth_host, auth_client = sim.auth_host, sim.auth_client
+    #time every phase of every frame, for the F4 overlay and (with profile_dump) the match dump
+    profiler = FrameProfiler(keep_all=bool(options.get("profile_dump")))
+    sim.profiler = profiler
+    race = RaceLoop(screen, sim, bg, pump, start_time=race_start_at, crash_sound=collision_sound,
+                    show_net_hud=bool(options.get("net_hud")), show_profiler=bool(options.get("profile_hud")))
+
+    #main game loop: the simulation and the network advance in fixed ticks of 1/FPS s whatever
+    #the render rate; frames in between are drawn interpolated between the last two ticks
+    render_fps = options.get("render_fps", RENDER_FPS)
+    last_time = time.perf_counter()
+    while race.running:
+        frame_start = time.perf_counter()
         for event in pygame.event.get():
             if event.type == pygame.QUIT:
-                running = False  # Window closed
-        #continuous movement based on key state
-        keys = pygame.key.get_pressed()
-        if keys[pygame.K_LEFT]:
-            car1.move(-7)
-        elif keys[pygame.K_RIGHT]:
-            car1.move(7)
-
-        #move obstacles and handle recycling and collisions
-        for idx, obstacle in enumerate(obstacles):
-            obstacle.move(5)  # move obstacle down
-            if obstacle.rect.y > SCREEN_HEIGHT:
-                #if obstacle goes off screen bottom, recycle it to top with new position
-                if not options.get("single_player") and network_role != "server":
-                    #in client mode, skip local respawn – wait for host sync
-                    continue
-                #compute new random lane and position for respawn
-                lane_choice = random.choice([0, 1])
-                if lane_choice == 0:
-                    lane_min = LANE_LEFT
-                    lane_max = LANE_LEFT + LANE_WIDTH - obstacle.rect.width
-                else:
-                    lane_min = LANE_LEFT + LANE_WIDTH
-                    lane_max = LANE_RIGHT - obstacle.rect.width
-                obstacle.rect.x = random.randint(lane_min, lane_max)
-                obstacle.rect.y = random.randint(-SCREEN_HEIGHT, -50)
-                #randomly choose a new obstacle image from current map set
-                new_img_idx = random.randrange(len(game_map.obstacle_images))
-                obstacle.image = game_map.obstacle_images[new_img_idx].copy()
-                obstacle.lane = lane_choice
-                #if host, queue this update event to send to client
-                if network_role == "server":
-                    events_queue.append({"index": idx, "x": obstacle.rect.x, "y": obstacle.rect.y, "img_index": new_img_idx})
-            #collision detection for player car (car1)
-            if obstacle.rect.colliderect(car1.hitbox):
-                car1.health -= 1
-                collision_sound.play()
-                #add an explosion effect centered on the player's car
-                explosion_x = car1.rect.centerx - explosion_image.get_width() // 2
-                explosion_y = car1.rect.centery - explosion_image.get_height() // 2
-                explosion_effects.append({"x": explosion_x, "y": explosion_y, "timer": 10})
-                #remove or reset the obstacle that was hit
-                if not options.get("single_player"):
-                    if network_role == "server":
-                        #host: reposition obstacle (like spawning a new one) and sync to client
-                        lane_choice = random.choice([0, 1])
-                        if lane_choice == 0:
-                            lane_min = LANE_LEFT
-                            lane_max = LANE_LEFT + LANE_WIDTH - obstacle.rect.width
-                        else:
-                            lane_min = LANE_LEFT + LANE_WIDTH
-                            lane_max = LANE_RIGHT - obstacle.rect.width
-                        obstacle.rect.x = random.randint(lane_min, lane_max)
-                        obstacle.rect.y = random.randint(-SCREEN_HEIGHT, -50)
-                        new_img_idx = random.randrange(len(game_map.obstacle_images))
-                        obstacle.image = game_map.obstacle_images[new_img_idx].copy()
-                        obstacle.lane = lane_choice
-                        #queue sync event for this collision reset
-                        events_queue.append({"index": idx, "x": obstacle.rect.x, "y": obstacle.rect.y, "img_index": new_img_idx})
-                    else:
-                        #client: push obstacle out of view (host will handle actual reset)
-                        obstacle.rect.y = SCREEN_HEIGHT + 100
-                else:
-                    #single-player: respawn obstacle at new random position
-                    lane_choice = random.choice([0, 1])
-                    if lane_choice == 0:
-                        lane_min = LANE_LEFT
-                        lane_max = LANE_LEFT + LANE_WIDTH - obstacle.rect.width
-                    else:
-                        lane_min = LANE_LEFT + LANE_WIDTH
-                        lane_max = LANE_RIGHT - obstacle.rect.width
-                    obstacle.rect.x = random.randint(lane_min, lane_max)
-                    obstacle.rect.y = random.randint(-SCREEN_HEIGHT, -50)
-                    obstacle.image = random.choice(game_map.obstacle_images).copy()
-                    obstacle.lane = lane_choice
-            #collision detection for opponent car (car2) - only handle in single-player or local context
-            if car2 and obstacle.rect.colliderect(car2.hitbox):
-                if options.get("single_player"):
-                    #in single-player (if we had ai), reduce opponent health
-                    car2.health -= 1
-                #multiplayer remote car collisions are handled by that player's instance)
-        #render background, cars, and obstacles
-        bg.draw(screen, speed=5)
-        #draw road boundary lines (for visual reference)
-        pygame.draw.rect(screen, (200, 200, 200), (ROAD_LEFT - 4, 0, 4, SCREEN_HEIGHT))
-        pygame.draw.rect(screen, (200, 200, 200), (ROAD_RIGHT + CAR_W, 0, 4, SCREEN_HEIGHT))
-        car1.draw(screen)
-        if car2:
-            car2.draw(screen)
-        for obstacle in obstacles:
-            #only draw obstacles that are on screen
-            if obstacle.rect.y < SCREEN_HEIGHT:
-                obstacle.draw(screen)
-        #draw explosion effects on top
-        for effect in explosion_effects:
-            if effect["timer"] > 0:
-                screen.blit(explosion_image, (effect["x"], effect["y"]))
-                effect["timer"] -= 1
-        explosion_effects = [eff for eff in explosion_effects if eff["timer"] > 0]
-        #hud: health & timer
-        health_text = font.render(f"Health: {car1.health}", True, WHITE)
-        time_left = max(0, int(total_time - (time.time() - start_time)))
-        time_text = font.render(f"Time: {time_left}", True, WHITE)
-        screen.blit(health_text, (10, 10))
-        screen.blit(time_text, (10, 40))
-        pygame.display.flip()
-        clock.tick(FPS)
-        #check for race end conditions
-        if car1.health <= 0 or (car2 and car2.health <= 0) or time.time() - start_time >= total_time:
-            running = False
+                race.running = False  # Window closed
+            elif event.type == pygame.KEYDOWN and event.key == pygame.K_F3:
+                race.show_net_hud = not race.show_net_hud
+            elif event.type == pygame.KEYDOWN and event.key == pygame.K_F4:
+                race.show_profiler = not race.show_profiler
+        profiler.lap("input")
+        now = time.perf_counter()
+        alpha = race.advance(now - last_time, keyboard_steer)
+        last_time = now
+        race.frame(alpha)
+        #read datagrams as they come in rather than once per tick, so their arrival times are
+        #right: with a frame cap, spend the time left in the frame waiting on the socket
+        if pump and render_fps and not vsync:
+            pump.wait(1.0 / render_fps - (time.perf_counter() - frame_start))
+        elif pump:
+            pump.drain()
+        #render rate: vsync paces flip() itself, otherwise cap it (0 = uncapped)
+        clock.tick(render_fps if render_fps and not vsync else 0)
+        profiler.lap("idle")
+        profiler.end_frame()
+    #exchange final results reliably so both sides judge the race on the same health values
+    if running_network and car2:
+        if auth_host:
+            #the host's numbers are final for both cars
+            reliable_channel.send(f"F,{car1.health},{car2.health}", key="F")
+        else:
+            reliable_channel.send(f"F,{car1.health}", key="F")
+        deadline = time.time() + 1.0
+        while time.time() < deadline and (remote_final_health is None or reliable_channel.pending()):
+            pump.poll()  # keep acks and retransmits flowing while we wait
+            pygame.time.delay(20)
+        if remote_final_health is not None and not auth_host:
+            car2.health = remote_final_health
+        if auth_client and remote_final_view is not None:
+            car1.health = remote_final_view
     if options.get("single_player"):
         #single‑player: loss if health hit zero; otherwise time ran out → win
         img_path = YOU_LOST_IMAGE_PATH if car1.health <= 0 else YOU_WON_IMAGE_PATH
@@ -815,8 +2221,7 @@ def run_game(options):
 
     #load and display the selected end‑screen for 2 seconds
     try:
-        end_img = pygame.image.load(img_path).convert()
-        end_img = pygame.transform.scale(end_img, (SCREEN_WIDTH, SCREEN_HEIGHT))
+        end_img = asset_cache.image(img_path, (SCREEN_WIDTH, SCREEN_HEIGHT), alpha=False)
         screen.blit(end_img, (0, 0))
         pygame.display.flip()
         pygame.time.delay(2000)
@@ -824,16 +2229,30 @@ def run_game(options):
         print(f"Error showing end‑screen ({img_path}): {e}")
     #
 
-    #clean up networking threads and socket after the race
-    if peer_socket:
+    #clean up networking after the race
+    if pump:
         running_network = False
-        if send_thread: send_thread.join(timeout=1.0)
-        if recv_thread: recv_thread.join(timeout=1.0)
-        try:
-            peer_socket.close()
-        except Exception:
-            pass
-    pygame.quit()
+        pump.close()
+        #keep the link quality of every match, to match complaints with network conditions
+        match_name = f"match_{options.get('match_id') or int(time.time())}_{options.get('username', '') or network_role}.json"
+        pump.telemetry.dump(os.path.join(TELEMETRY_DIR, match_name), {
+            "match_id": options.get("match_id", ""),
+            "role": network_role,
+            "opponent": options.get("opponent", ""),
+            "netcode": netcode_mode,
+            "relayed": pump.relayed,
+        })
+    if options.get("profile_dump"):
+        frames_name = f"frames_{options.get('match_id') or int(time.time())}_{options.get('username', '') or network_role or 'local'}.json"
+        profiler.dump(os.path.join(TELEMETRY_DIR, frames_name), {
+            "match_id": options.get("match_id", ""),
+            "map": map_choice,
+            "difficulty": options["difficulty"],
+            "netcode": netcode_mode if pump else "offline",
+        })
+    #close the window only: the mixer (and the cached sounds) stay up for the next race
+    pygame.mixer.music.stop()
+    pygame.display.quit()
 
     #determine race result (if multiplayer)
     if car2:
@@ -874,6 +2293,19 @@ class ChallengeDialog(QDialog):
 
 #network handler (client-side server communication)
 
+PROBE_PINGS = 4      # small pings for the rtt to the lobby, then the padded ones for the uplink
+PROBE_PADDED = 5     # padded pings; the median of their extra time is used, not one sample
+PROBE_PAD = 900      # padding bytes on the padded pings (the server reads 1024 at a time)
+
+def probe_cpu_ms():
+    """Time a fixed slice of host-only work (obstacle respawn rolls) as a rough cpu score."""
+    start = time.perf_counter()
+    for i in range(100):
+        rng = obstacle_rng(0, i % 5, i)
+        rng.randint(ROAD_LEFT, ROAD_RIGHT)
+        rng.randint(-600, -100)
+    return (time.perf_counter() - start) * 1000
+
 class NetworkHandler(QObject):
     challenge_received = pyqtSignal(str)   #emitted when a challenge request arrives
     match_started = pyqtSignal(dict)       #emitted when a match start is triggered
@@ -884,8 +2316,33 @@ class NetworkHandler(QObject):
     def __init__(self, parent=None):
         super().__init__(parent)
         self.socket = None
+        self.server_ip = None
+        self.username = None
         self.running = False
         self.receive_thread = None
+        self.p2p_socket = None   # udp socket for the next match, bound to an os-chosen port
+        self.probe = None        # host-selection probe in progress, see on_probe_pong
+        self.reg_secret = ""     # from the login reply; proves our REG datagrams are ours
+
+    def p2p_port(self):
+        """Port of the udp socket the next match will use, binding one if needed."""
+        if self.p2p_socket is None:
+            self.p2p_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.p2p_socket.bind(("", 0))
+        #let the server see the public endpoint our nat maps this socket to (a few copies, it's udp)
+        for _ in range(3):
+            try:
+                reg = f"REG,{self.username},{self.reg_secret}" if self.reg_secret else f"REG,{self.username}"
+                self.p2p_socket.sendto(reg.encode(), (self.server_ip, LOBBY_UDP_PORT))
+            except OSError as e:
+                print(f"Registration error: {e}")
+                break
+        return self.p2p_socket.getsockname()[1]
+
+    def take_p2p_socket(self):
+        """Hand the bound udp socket over to a starting match (the game closes it)."""
+        sock, self.p2p_socket = self.p2p_socket, None
+        return sock
 
     def connect_to_server(self, server_ip, username, password):
         """Connect to the main server and log in, starting the listener thread."""
@@ -893,9 +2350,12 @@ class NetworkHandler(QObject):
             self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.socket.settimeout(2)
             self.socket.connect((server_ip, 8005))
+            self.server_ip = server_ip
+            self.username = username
             self.socket.settimeout(None)
-            self.socket.send(f"LOGIN:{username}:{password}".encode())
-            response = self.socket.recv(1024).decode().strip()
+            #ask for the secret that keeps others from registering our p2p endpoint
+            self.socket.send(f"LOGIN:{username}:{password}:reg".encode())
+            response, _, self.reg_secret = self.socket.recv(1024).decode().split("\n")[0].strip().partition(":")
             if response == "LOGIN_SUCCESS":
                 #maintain connection and start listening thread for async messages
                 self.running = True
@@ -914,7 +2374,7 @@ class NetworkHandler(QObject):
         """Send a challenge request that also carries the letter of my car."""
         try:
         #adds the 4th field
-            self.socket.send(f"CHALLENGE:{challenger}:{challenged}:{car_choice}".encode())
+            self.socket.send(f"CHALLENGE:{challenger}:{challenged}:{car_choice}:{self.p2p_port()}".encode())
             return True
         except Exception as e:
             print(f"Challenge error: {e}")
@@ -923,14 +2383,38 @@ class NetworkHandler(QObject):
     def respond_to_challenge(self, username, response, car_choice=None):
         try:
             msg = f"CHALLENGE_RESPONSE:{username}:{response}"
-            if car_choice:                
-                msg += f":{car_choice}"  
+            if response == "ACCEPT":
+                #an empty car makes the server use the stored one
+                msg += f":{car_choice or ''}:{self.p2p_port()}"
+            elif car_choice:
+                msg += f":{car_choice}"
             self.socket.send(msg.encode())
             return True
         except Exception as e:
             print(f"Challenge response error: {e}")
             return False
 
+    def send_probe_ping(self, n):
+        pad = ":" + "x" * PROBE_PAD if n >= PROBE_PINGS else ""
+        self.probe["sent"] = time.perf_counter()
+        self.socket.send(f"PROBE_PING:{self.probe['match_id']}:{n}{pad}".encode())
+
+    def on_probe_pong(self, n):
+        """Record one ping, then send the next or report the result so the server can pick the host."""
+        probe = self.probe
+        probe["samples"].append((time.perf_counter() - probe["sent"]) * 1000)
+        if n < PROBE_PINGS + PROBE_PADDED - 1:
+            self.send_probe_ping(n + 1)
+            return
+        self.probe = None
+        rtt = min(probe["samples"][:PROBE_PINGS])
+        #the padded pings take longer by roughly the time to push the padding up our link;
+        #when they don't (a lan, or jitter bigger than that time) the uplink is unknown (0)
+        #and the server keeps the default host
+        extra = sorted(probe["samples"][PROBE_PINGS:])[PROBE_PADDED // 2] - rtt
+        uplink_kbps = PROBE_PAD * 8 / extra if extra > 0 else 0
+        self.socket.send(f"PROBE_RESULT:{probe['match_id']}:{rtt:.2f}:{uplink_kbps:.0f}:{probe['cpu_ms']:.2f}".encode())
+
     def update_status(self, status):
         """Optional: send a status update (not used extensively)."""
         try:
@@ -940,43 +2424,79 @@ class NetworkHandler(QObject):
         except Exception:
             return False
 
+    def handle_server_message(self, data):
+        """Dispatch one newline-terminated message from the server."""
+        if data == "CHALLENGE_SENT":
+            self.challenge_sent.emit()
+        elif data.startswith("CHALLENGE_REQUEST:"):
+            #incoming challenge from another player
+            challenger = data.split(":")[1]
+            self.challenge_received.emit(challenger)
+        elif data.startswith("PROBE:"):
+            #server measures both players before picking the host
+            self.probe = {"match_id": data.split(":")[1], "samples": [], "cpu_ms": probe_cpu_ms()}
+            self.send_probe_ping(0)
+        elif data.startswith("PROBE_PONG:"):
+            parts = data.split(":")
+            if self.probe and len(parts) >= 3 and parts[1] == self.probe["match_id"] and parts[2].isdigit():
+                self.on_probe_pong(int(parts[2]))
+        elif data.startswith("MATCH_START:"):
+            #match starting, format: match_start:matchid:role:opp_ip:opp_port:opp_car:opp_name[:seed[:token[:relay_port[:public_ip:public_port]]]]
+            parts = data.split(":")
+            if len(parts) >= 7 and parts[2] in ("server","client") and parts[4].isdigit():
+                match_id = parts[1]; role = parts[2]; opp_ip = parts[3]; opp_port =parts[4] ; opp_car = parts[5];opp_name = parts[6]
+                match_info = {
+                    "match_id": match_id,
+                    "role": role,
+                    "opp_ip": opp_ip,
+                    "opponent_port": int(opp_port),
+                    "opp_car": opp_car,
+                    "opponent_name": opp_name
+                }
+                #older servers don't send a shared obstacle seed
+                if len(parts) >= 8 and parts[7].isdigit():
+                    match_info["seed"] = int(parts[7])
+                if len(parts) >= 9 and parts[8]:
+                    match_info["token"] = parts[8]
+                if len(parts) >= 10 and parts[9].isdigit():
+                    match_info["relay"] = (self.server_ip, int(parts[9]))
+                if len(parts) >= 12 and parts[10] and parts[11].isdigit():
+                    match_info["opp_public"] = (parts[10], int(parts[11]))
+                self.match_started.emit(match_info)
+            elif len(parts) >= 3:
+                match_id = parts[1]; role = parts[2]
+                self.match_started.emit({"match_id": match_id, "role": role})
+        elif data == "CHALLENGE_REJECTED":
+            self.challenge_rejected.emit()
+        elif data == "OPPONENT_NOT_AVAILABLE":
+            self.opponent_unavailable.emit()
+        #ignore other messages like result_updated or status acknowledgments
+
     def receive_loop(self):
         """Background thread to handle incoming server messages (challenges, match start, etc.)."""
+        buffer = ""
         while self.running:
             try:
-                data = self.socket.recv(1024).decode().strip()
-                if not data:
-                    break  #connection closed
-                elif data == "CHALLENGE_SENT":
-                   self.challenge_sent.emit()
-                   continue
-                if data.startswith("CHALLENGE_REQUEST:"):
-                    #incoming challenge from another player
-                    challenger = data.split(":")[1]
-                    self.challenge_received.emit(challenger)
-                elif data.startswith("MATCH_START:"):
-                    #match starting, format: match_start:matchid:role:opp_ip:opp_port:opp_car
-                    parts = data.split(":")
-                    if len(parts) >= 7 and parts[2] in ("server","client"):
-                        match_id = parts[1]; role = parts[2]; opp_ip = parts[3]; opp_port =parts[4] ; opp_car = parts[5];opp_name = parts[6]
-                        self.match_started.emit({
-                            "match_id": match_id,
-                            "role": role,
-                            "opp_ip": opp_ip,
-                            "opponent_port": int(opp_port),
-                            "opp_car": opp_car,
-                            "opponent_name": opp_name
-                        })
-                    elif len(parts) >= 3:
-                        match_id = parts[1]; role = parts[2]
-                        self.match_started.emit({"match_id": match_id, "role": role})
-                elif data == "CHALLENGE_REJECTED":
-                    self.challenge_rejected.emit()       
-                elif data == "OPPONENT_NOT_AVAILABLE":
-                    self.opponent_unavailable.emit()     
-                #ignore other messages like result_updated or status acknowledgments
-            except Exception as e:
+                chunk = self.socket.recv(1024).decode()
+            except Exception:
                 break
+            if not chunk:
+                break  #connection closed
+            #tcp doesn't keep message boundaries: one recv can hold several messages (a probe
+            #pong and the match start) or part of one, so split on the newline every message ends with
+            buffer += chunk
+            *messages, buffer = buffer.split("\n")
+            for data in messages:
+                data = data.strip()
+                if not data:
+                    continue
+                try:
+                    self.handle_server_message(data)
+                except OSError:
+                    self.running = False  #can't answer the server any more
+                    break
+                except Exception as e:
+                    print(f"Bad message from server ({data[:40]!r}): {e}")
         #mark as disconnected if loop exits
         self.running = False
         if self.socket:
@@ -1050,6 +2570,8 @@ class MainWindow(QWidget):
         #display the current username on the gui
         self.username_edit.setText(self.username)
         self.username_edit.setReadOnly(True)
+        #decode the race assets while the player is in the lobby
+        preload_game_assets()
 
     def setup_options_tab(self):
         #1)name the tab so the stylesheet only affects this page
@@ -1129,6 +2651,33 @@ class MainWindow(QWidget):
         self.opponent_combo.addItem("Fetching…")
         settings_layout.addWidget(self.opponent_combo,     2,3)
 
+        #row 3
+        settings_layout.addWidget(QLabel("Netcode:"),      3,0)
+        self.netcode_combo = QComboBox()
+        self.netcode_combo.addItems(list(NETCODE_MODES.keys()))
+        settings_layout.addWidget(self.netcode_combo,      3,1)
+
+        settings_layout.addWidget(QLabel("Frame Rate:"),   3,2)
+        self.render_rate_combo = QComboBox()
+        self.render_rate_combo.addItems(list(RENDER_RATES.keys()))
+        settings_layout.addWidget(self.render_rate_combo,  3,3)
+
+        #row 4: local preferences, they don't have to match the opponent's
+        self.pixel_collisions_check = QCheckBox("Pixel-accurate collisions")
+        self.pixel_collisions_check.setStyleSheet("color: white; font-weight: bold;")
+        settings_layout.addWidget(self.pixel_collisions_check, 4,0,1,2)
+        self.profile_dump_check = QCheckBox("Save frame timings")
+        self.profile_dump_check.setStyleSheet("color: white; font-weight: bold;")
+        settings_layout.addWidget(self.profile_dump_check,     4,2,1,2)
+        self.vsync_check = QCheckBox("Vsync")
+        self.vsync_check.setStyleSheet("color: white; font-weight: bold;")
+        settings_layout.addWidget(self.vsync_check,            5,0,1,2)
+        #vsync needs pygame's SCALED display mode, which can enlarge the window
+        vsync_note = QLabel("Vsync may scale the window up on high-DPI or large displays")
+        vsync_note.setStyleSheet("color: white; font-weight: normal;")
+        self.vsync_check.setToolTip(vsync_note.text())
+        settings_layout.addWidget(vsync_note,                  5,2,1,2)
+
         settings_gb.setLayout(settings_layout)
         outer.addWidget(settings_gb)
 
@@ -1253,6 +2802,18 @@ class MainWindow(QWidget):
             #user rejected the challenge
             self.network_handler.respond_to_challenge(self.username, "REJECT")
 
+    def race_options(self):
+        """Local preferences from the setup tab, for single-player and match races alike."""
+        return {
+            #hits only when the sprites' opaque pixels overlap (never in lockstep)
+            "pixel_collisions": self.pixel_collisions_check.isChecked(),
+            #every frame's phase timings go to telemetry/frames_*.json after the race
+            "profile_dump": self.profile_dump_check.isChecked(),
+            #with vsync the display paces the frames and the frame rate cap is not used
+            "vsync": self.vsync_check.isChecked(),
+            "render_fps": RENDER_RATES.get(self.render_rate_combo.currentText(), RENDER_FPS),
+        }
+
     def handle_match_start(self, match_info):
         """Start the game when a match is confirmed by the server."""
         #prepare game options including networking details
@@ -1265,7 +2826,9 @@ class MainWindow(QWidget):
             "difficulty": self.difficulty_combo.currentText(),
             "car_color": self.car_combo.currentText(),
             "match_id": match_info.get("match_id", ""),
-            "role": match_info.get("role", "")
+            "role": match_info.get("role", ""),
+            #only the host's choice counts, it is sent to the client with the race start
+            "netcode": NETCODE_MODES.get(self.netcode_combo.currentText(), "p2p")
         }
         options["opponent"] = match_info.get(          "opponent_name",
            getattr(self, "current_opponent", "")        )
@@ -1277,6 +2840,21 @@ class MainWindow(QWidget):
             options["opponent_port"] = int(opp_port_val)
         if "opp_car" in match_info:
             options["opponent_car"] = match_info["opp_car"]
+        if "seed" in match_info:
+            options["seed"] = match_info["seed"]
+        #a token means the server relayed the os-chosen ports we reported with the challenge;
+        #older servers assume the fixed ports instead
+        p2p_socket = self.network_handler.take_p2p_socket()
+        if "token" in match_info:
+            options["match_token"] = match_info["token"]
+            options["p2p_socket"] = p2p_socket
+            if "relay" in match_info:
+                options["relay"] = match_info["relay"]
+            if "opp_public" in match_info:
+                options["opponent_public"] = match_info["opp_public"]
+        elif p2p_socket is not None:
+            p2p_socket.close()
+        options.update(self.race_options())
         #pass the network handler for result reporting
         options["network_handler"] = self.network_handler
         self.start_game(options)
@@ -1293,6 +2871,7 @@ class MainWindow(QWidget):
             "username": self.username,
             "single_player": True
         }
+        options.update(self.race_options())
         run_game(options)
 
     def start_game(self, options):